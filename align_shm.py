@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Matching abnum numbered residues to the columns of an agl alignment.
+#
+# The input row of an agl alignment is the numbered sequence with pieces left
+# out (the part of CDR-H3 between the V and J genes, residues agl does not
+# align) and sometimes with extra residues or 'X' padding. Identical residues
+# of the two sequences are paired by dynamic programming with affine gaps:
+# every pair scores MATCH and every run of unpaired residues costs GAP_OPEN,
+# with MATCH large enough that the most pairs always win and gaps only decide
+# between equally long pairings, keeping the pairs in as few runs as possible.
+#
+# The table is restricted to a band around the diagonal: alignment column j
+# is only considered for numbered residue i if j - i lies within BAND_MARGIN
+# of the range between 0 and the length difference of the two sequences, so a
+# chain costs time in proportion to its length times the band width. If the
+# true alignment strays further than that, the pairing found is the best one
+# within the band rather than the best overall.
+#
+# A batch of chains is aligned together: the chains are padded to the same
+# length and each row of the table, and each step of the traceback, is
+# computed for CHUNK_CHAINS chains at once with NumPy.
+#
+# pair_numbering() takes a batch of chains and returns, for each, the
+# [position, input, germline] rows of the paired residues.
+
+import numpy as np
+
+BAND_MARGIN = 8
+CHUNK_CHAINS = 256
+MATCH = 4096
+GAP_OPEN = 1
+NO_SCORE = -(1 << 30)
+# Padding that never matches a residue
+NUM_PAD = 0
+ALN_PAD = 255
+M, U, L = 0, 1, 2
+
+
+def encode(seqs, n_cols, pad):
+    codes = np.full((len(seqs), n_cols), pad, dtype=np.uint8)
+    for row, seq in enumerate(seqs):
+        codes[row, :len(seq)] = np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+    return codes
+
+
+def shift(values, by):
+    # Moves values along the band by 'by' places, filling with NO_SCORE
+    shifted = np.full_like(values, NO_SCORE)
+    if by > 0:
+        shifted[..., by:] = values[..., :-by]
+    else:
+        shifted[..., :by] = values[..., -by:]
+    return shifted
+
+
+def pair_chunk(num_seqs, aln_seqs, margin):
+    n_chains = len(num_seqs)
+    n = np.array([len(s) for s in num_seqs], dtype=np.int64)
+    m = np.array([len(s) for s in aln_seqs], dtype=np.int64)
+    n_max = int(n.max())
+    m_max = max(int(m.max()), 1)
+    pairs = np.full((n_chains, n_max), -1, dtype=np.int64)
+
+    # Band index b of row i is column j = i + lo + b. (i-1, j-1) is then band
+    # b of the row before, (i-1, j) band b+1 and (i, j-1) band b-1
+    lo = np.minimum(0, m - n) - margin
+    width = int((np.abs(m - n) + 2 * margin + 1).max())
+    band = np.arange(width)
+    chains = np.arange(n_chains)
+    num = encode(num_seqs, n_max, NUM_PAD)
+    aln = encode(aln_seqs, m_max, ALN_PAD)
+
+    # table[i, state, chain, b] is the best score of the first i numbered and
+    # first j alignment residues ending with a pair (M), an unpaired numbered
+    # residue (U) or an unpaired alignment residue (L)
+    table = np.full((n_max + 1, 3, n_chains, width), NO_SCORE, dtype=np.int32)
+    for i in range(n_max + 1):
+        cols = i + lo[:, None] + band
+        valid = (cols >= 0) & (cols <= m[:, None])
+        if i == 0:
+            pair = np.where(cols == 0, 0, NO_SCORE)
+            up = np.full_like(pair, NO_SCORE)
+        else:
+            prev = table[i - 1]
+            match = (np.take_along_axis(aln, np.clip(cols - 1, 0, m_max - 1), axis=1) == num[:, i - 1:i]) & \
+                (cols >= 1)
+            best = prev.max(axis=0)
+            pair = np.where(match & (best > NO_SCORE), best + MATCH, NO_SCORE)
+            up = np.maximum(shift(prev[U], -1), shift(np.maximum(prev[M], prev[L]), -1) - GAP_OPEN)
+        pair = np.where(valid, pair, NO_SCORE)
+        up = np.where(valid & (up > NO_SCORE // 2), up, NO_SCORE)
+        # A run of unpaired alignment residues starts from the best M or U
+        # cell to its left, so the L scores are a running maximum along the row
+        left = shift(np.maximum.accumulate(np.maximum(pair, up) - GAP_OPEN, axis=1), 1)
+        left = np.where(valid & (left > NO_SCORE // 2), left, NO_SCORE)
+        table[i] = [pair, up, left]
+
+    # Traceback of all the chains together from (n, m), preferring pairs, then
+    # unpaired numbered residues
+    i = n.copy()
+    j = m.copy()
+    b = j - i - lo
+    state = table[i, :, chains, b].argmax(axis=1)
+    active = (i > 0) & (j > 0)
+    while active.any():
+        c = chains[active]
+        ci = i[c]
+        cb = b[c]
+        cs = state[c]
+        here = table[ci, cs, c, cb]
+        next_state = cs.copy()
+        is_m = cs == M
+        is_u = cs == U
+        is_l = cs == L
+        pairs[c[is_m], ci[is_m] - 1] = j[c[is_m]] - 1
+        # M came from the best state of (i-1, j-1)
+        next_state[is_m] = table[ci[is_m] - 1, :, c[is_m], cb[is_m]].argmax(axis=1)
+        # U and L either carried on a run or opened it from another state
+        up_b = np.minimum(cb + 1, width - 1)
+        from_up = table[np.maximum(ci - 1, 0), :, c, up_b]
+        opened = is_u & (from_up[:, U] != here)
+        next_state[opened] = np.where(from_up[opened, M] - GAP_OPEN == here[opened], M, L)
+        left_b = np.maximum(cb - 1, 0)
+        from_left = table[ci, :, c, left_b]
+        opened = is_l & (from_left[:, L] != here)
+        next_state[opened] = np.where(from_left[opened, M] - GAP_OPEN == here[opened], M, U)
+        # Moving up one row keeps j, so the band index goes up by one
+        i[c] = ci - (is_m | is_u)
+        j[c] = j[c] - (is_m | is_l)
+        b[c] = cb + is_u - is_l
+        state[c] = next_state
+        active = (i > 0) & (j > 0)
+    return pairs
+
+
+def pair_columns(num_seqs, aln_seqs, margin=BAND_MARGIN):
+    # For a batch of (numbered residue string, alignment residue string) pairs
+    # returns, for each chain, an array giving the alignment column paired with
+    # each numbered residue, or -1
+    results = []
+    for start in range(0, len(num_seqs), CHUNK_CHAINS):
+        chunk_num = num_seqs[start:start + CHUNK_CHAINS]
+        chunk_aln = aln_seqs[start:start + CHUNK_CHAINS]
+        if max(len(s) for s in chunk_num) == 0:
+            results.extend(np.zeros(0, dtype=np.int64) for _ in chunk_num)
+            continue
+        pairs = pair_chunk(chunk_num, chunk_aln, margin)
+        results.extend(pairs[row, :len(seq)] for row, seq in enumerate(chunk_num))
+    return results
+
+
+def pair_numbering(num_lists, mut_lists):
+    # num_lists: for each chain, the abnum [position, residue] list
+    # mut_lists: for each chain, the agl [input, germline] column list
+    pairs = pair_columns([''.join(res for _, res in num_list) for num_list in num_lists],
+                         [''.join(inp for inp, _ in mut_list) for mut_list in mut_lists])
+    results = []
+    for num_list, mut_list, columns in zip(num_lists, mut_lists, pairs):
+        results.append([[num_list[i][0], mut_list[j][0], mut_list[j][1]]
+                        for i, j in enumerate(columns) if j >= 0])
+    return results
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Persistent on-disk cache for the output of the external tools (agl, abnum,
+# abpackingangle).
+#
+# An entry is keyed by a hash of the input file bytes (or of the bytes sent to
+# the tool on stdin), the tool name, the argument list and the tool version
+# (taken from the size and modification time of the installed binary), so that
+# changing any of these gives a miss.
+# The cache is size bounded; the least recently used entries are removed once
+# the total size goes over the limit.
+#
+# The settings are kept in environment variables so that worker processes
+# started with the 'spawn' method pick up the same cache as the parent.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import utils_shm
+from contextlib import contextmanager
+from functools import lru_cache
+
+INPUT_PLACEHOLDER = '{input}'
+
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+_cache_size = None
+
+
+def configure(cache_dir=None, max_mb=None, enabled=True):
+    if cache_dir is not None:
+        os.environ['SHM_CACHE_DIR'] = cache_dir
+    if max_mb is not None:
+        os.environ['SHM_CACHE_MAX_MB'] = str(max_mb)
+    os.environ['SHM_CACHE'] = '1' if enabled else '0'
+
+
+def cache_dir():
+    return os.environ.get('SHM_CACHE_DIR', '.shm_cache')
+
+
+def max_bytes():
+    return int(float(os.environ.get('SHM_CACHE_MAX_MB', 2048)) * 1024 * 1024)
+
+
+def is_enabled():
+    return os.environ.get('SHM_CACHE', '1') != '0'
+
+
+@lru_cache(maxsize=None)
+def tool_version(tool):
+    path = shutil.which(tool)
+    if path is None:
+        return tool
+    st = os.stat(path)
+    return f'{path}:{st.st_size}:{st.st_mtime_ns}'
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def make_key(args, input_path):
+    # The input path itself is not part of the key, only its contents, so that
+    # a renamed or copied file is still a hit
+    tool = args[0]
+    key_args = [INPUT_PLACEHOLDER if a == input_path else a for a in args[1:]]
+    desc = json.dumps([tool, key_args, tool_version(tool), file_digest(input_path)])
+    return hashlib.sha256(desc.encode('utf-8')).hexdigest()
+
+
+def data_key(args, data):
+    # Key for a tool run that is given its input (bytes) on stdin
+    tool = args[0]
+    desc = json.dumps([tool, args[1:], tool_version(tool), hashlib.sha256(data).hexdigest(), 'stdin'])
+    return hashlib.sha256(desc.encode('utf-8')).hexdigest()
+
+
+def entry_path(key):
+    return os.path.join(cache_dir(), key[:2], key)
+
+
+def lookup(key):
+    path = entry_path(key)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        stats['misses'] += 1
+        return None
+    # The modification time marks when an entry was last used
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    stats['hits'] += 1
+    return data
+
+
+def store(key, data):
+    global _cache_size
+    path = entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename so that parallel runs never read half-written entries
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    # An entry that is written again replaces the old one, so only the
+    # difference in size is added
+    try:
+        old_size = os.path.getsize(path)
+    except FileNotFoundError:
+        old_size = 0
+    os.replace(tmp_path, path)
+    if _cache_size is None:
+        _cache_size = sum(size for _, size, _ in list_entries())
+    else:
+        _cache_size += len(data) - old_size
+    if _cache_size > max_bytes():
+        evict()
+
+
+def list_entries():
+    entries = []
+    top = cache_dir()
+    if not os.path.isdir(top):
+        return entries
+    for sub in os.listdir(top):
+        sub_path = os.path.join(top, sub)
+        if not os.path.isdir(sub_path):
+            continue
+        for name in os.listdir(sub_path):
+            path = os.path.join(sub_path, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+    return entries
+
+
+def evict():
+    # Remove the least recently used entries until the cache is at 90% of its limit
+    global _cache_size
+    entries = sorted(list_entries(), key=lambda e: e[2])
+    total = sum(size for _, size, _ in entries)
+    target = max_bytes() * 0.9
+    for path, size, _ in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+            stats['evictions'] += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    _cache_size = total
+
+
+def report():
+    if is_enabled():
+        print(f'Tool cache: {stats["hits"]} hits, {stats["misses"]} misses, '
+              f'{stats["evictions"]} evictions ({cache_dir()})')
+
+
+@contextmanager
+def test_cache():
+    # Points the cache settings at an empty directory that holds at most 1000
+    # bytes, and puts them back afterwards
+    global _cache_size
+    saved = {name: os.environ.get(name) for name in ['SHM_CACHE_DIR', 'SHM_CACHE_MAX_MB', 'SHM_CACHE']}
+    saved_size = _cache_size
+    with tempfile.TemporaryDirectory() as directory:
+        configure(os.path.join(directory, 'cache'), 1000 / (1024 * 1024))
+        _cache_size = None
+        try:
+            yield directory
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            _cache_size = saved_size
+
+
+def run_test_keys():
+    with test_cache() as directory:
+        paths = [os.path.join(directory, name) for name in ['a.faa', 'b.faa', 'c.faa']]
+        for path, text in zip(paths, ['>a\nEVQL\n', '>a\nEVQL\n', '>a\nEVQM\n']):
+            with open(path, 'w') as f:
+                f.write(text)
+        keys = [make_key(['agl', '-a', path], path) for path in paths]
+        # Only the contents of the input count, not its name
+        utils_shm.check_equal([keys[0] == keys[1], keys[0] == keys[2]], [True, False])
+        utils_shm.check_equal(make_key(['agl', '-H', paths[0]], paths[0]) == keys[0], False)
+        stdin_key = data_key(['agl', '-a'], b'>a\nEVQL\n')
+        utils_shm.check_equal([stdin_key == data_key(['agl', '-a'], b'>a\nEVQL\n'),
+                               stdin_key == data_key(['agl', '-a'], b'>a\nEVQM\n'),
+                               stdin_key in keys], [True, False, False])
+
+
+def run_test_eviction():
+    with test_cache():
+        for key in ['aa1', 'bb2', 'cc3']:
+            store(key, b'x' * 300)
+        for when, key in enumerate(['aa1', 'bb2', 'cc3']):
+            os.utime(entry_path(key), (when + 1, when + 1))
+        # Using aa1 makes bb2 the least recently used entry
+        utils_shm.check_equal(lookup('aa1'), b'x' * 300)
+        store('dd4', b'x' * 300)
+        remaining = sorted(os.path.basename(path) for path, _, _ in list_entries())
+        utils_shm.check_equal(remaining, ['aa1', 'cc3', 'dd4'])
+        utils_shm.check_equal(_cache_size, 900)
+
+
+def run_test_overwrite_size():
+    with test_cache():
+        store('aa1', b'x' * 300)
+        store('aa1', b'x' * 300)
+        store('aa1', b'x' * 200)
+        utils_shm.check_equal(_cache_size, 200)
+        utils_shm.check_equal(sum(size for _, size, _ in list_entries()), 200)
+
+
+# *************************************************************************
+if __name__ == '__main__':
+    run_test_keys()
+    run_test_eviction()
+    run_test_overwrite_size()
@@ -8,44 +8,227 @@
 # FT                   /organism="Homo sapiens"
 # /protein_id=
 import argparse
+import bz2
+import csv
+import gzip
+import hashlib
+import io
+import mmap
 import os
 import pandas as pd
 import subprocess
 import re
+import faidx_shm
 import graphing_shm as graph
+import utils_shm
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 
-def get_data4fasta(file, dire):
-    rel_lines = ''
-    with open(os.path.join(file), 'r') as f:
-        for line in f:
-            if line.startswith('FT                   ') or line.startswith('AC') or line.startswith('//'):
-                rel_lines = rel_lines + line
-    files = rel_lines.split('//')
-    files = [file for file in files if 'FT                   /organism="Homo sapiens"' in file or 'FT                   /organism="Mus musculus"' in file]
-    for file in files:
-        filter_file(file, dire)
-    return
+SPECIES = ['Homo sapiens', 'Mus musculus']
+# Feature table qualifiers start after 'FT' and 19 spaces
+QUALIFIER_COLUMN = 21
+# Size of the pieces a file is split into for parsing in parallel
+SHARD_BYTES = 64 * 1024 * 1024
+MAPPING_COLUMNS = ['accession', 'protein_id', 'organism', 'sequence_hash']
+
+
+def parse_embl_records(lines):
+    # Yields (accession, organism, protein_id, translation) for each
+    # '//'-terminated entry, reading the lines once. Only the first organism,
+    # protein_id and translation of an entry are kept; missing ones are ''
+    accession = organism = protein_id = ''
+    translation = []
+    in_translation = False
+    seen_translation = False
+    started = False
+    for line in lines:
+        tag = line[:2]
+        if tag == 'FT':
+            text = line[QUALIFIER_COLUMN:].strip()
+            if in_translation:
+                translation.append(text)
+                in_translation = not text.endswith('"')
+            elif text.startswith('/'):
+                if text.startswith('/organism=') and not organism:
+                    organism = text[len('/organism='):].strip('"')
+                elif text.startswith('/protein_id=') and not protein_id:
+                    protein_id = text[len('/protein_id='):].strip('"')
+                elif text.startswith('/translation=') and not seen_translation:
+                    text = text[len('/translation='):]
+                    translation.append(text)
+                    seen_translation = True
+                    # The sequence runs on until the closing quote
+                    in_translation = len(text) < 2 or not text.endswith('"')
+        elif tag == 'AC':
+            if not accession:
+                accession = line[2:].split(';')[0].strip()
+        elif tag == '//':
+            yield accession, organism, protein_id, ''.join(translation).replace('"', '').replace(' ', '')
+            accession = organism = protein_id = ''
+            translation = []
+            in_translation = seen_translation = started = False
+            continue
+        else:
+            continue
+        started = True
+    if started:
+        # Last entry without a closing '//'
+        yield accession, organism, protein_id, ''.join(translation).replace('"', '').replace(' ', '')
+
+
+def open_embl(path, mode='rt'):
+    # Plain, gzip (.gz) or bzip2 (.bz2) EMBL files
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    if path.endswith('.bz2'):
+        return bz2.open(path, mode)
+    return open(path, mode)
+
+
+def read_embl_records(path):
+    with open_embl(path) as f:
+        yield from parse_embl_records(f)
+
+
+def wanted(record):
+    # Human or mouse entries with a translation
+    return record[1] in SPECIES and bool(record[0]) and bool(record[3])
+
+
+# *************************************************************************
+# Parallel conversion
+#
+# A plain file is split into byte ranges that each start just after a '//'
+# line, found through an mmap of the file, and each range is parsed by a
+# worker process reading it through its own mmap. A compressed file cannot be
+# read from an offset, so it is decompressed here and handed to the workers in
+# blocks of whole entries. The records come back in file order.
+
+def shard_offsets(path, n_shards):
+    # Byte offsets splitting the file into up to n_shards ranges of whole entries
+    size = os.path.getsize(path)
+    offsets = [0]
+    if size == 0:
+        return offsets + [0]
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(1, n_shards):
+            # A '//' line starting right at the target counts too
+            pos = mm.find(b'\n//', max(size * i // n_shards, offsets[-1]) - 1)
+            if pos == -1:
+                break
+            end = mm.find(b'\n', pos + 1)
+            if end == -1 or end + 1 >= size:
+                break
+            if end + 1 > offsets[-1]:
+                offsets.append(end + 1)
+    return offsets + [size]
+
+
+def shard_lines(path, start, end):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        mm.seek(start)
+        while mm.tell() < end:
+            yield mm.readline().decode()
+
 
+def compressed_blocks(path, block_size=SHARD_BYTES):
+    # Blocks of text of a compressed file, each ending after a '//' line
+    rest = b''
+    with open_embl(path, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            data = rest + data
+            end = data.rfind(b'\n//')
+            end = data.find(b'\n', end + 1) if end != -1 else -1
+            if end == -1:
+                rest = data
+                continue
+            yield data[:end + 1].decode()
+            rest = data[end + 1:]
+    if rest:
+        yield rest.decode()
 
-def filter_file(f, direct):
-    fasta_data = ['AC', 'FT                   /protein_id', 'FT                   /translation']
-    ignore = ['FT                   /', 'AC']
-    lines = f.split('\n')
-    firsthalf = [l for l in lines if l.startswith(tuple(fasta_data))]
-    secondhalf = [l for l in lines if not l.startswith(tuple(ignore))]
-    rel_lines = firsthalf + secondhalf
-    rel_lines = [l.replace(' ', '') for l in rel_lines]
-    rel_lines = [l[2:].replace('"', '') for l in rel_lines if l != '']
-    rel_lines = [l.replace('/protein_id=', '') for l in rel_lines]
-    rel_lines = [l.replace('/translation=', '') for l in rel_lines]
-    rel_lines = [l.replace(';', '') for l in rel_lines]
-    rel_lines = [l for l in rel_lines if not l.islower()]
-    rel_lines = [l for l in rel_lines if l.isupper() == True]
-    final = rel_lines[:2] + [''.join(rel_lines[2:])]
-
-    with open(os.path.join(direct, f'{final[0]}.faa'), 'w') as fasta:
-        fasta.write(f'>{final[1]}\n{final[2]}')
+
+def parse_shard(shard):
+    # shard is (path, start, end) of a plain file, or a block of text
+    if isinstance(shard, tuple):
+        lines = shard_lines(*shard)
+    else:
+        lines = io.StringIO(shard)
+    return [record for record in parse_embl_records(lines) if wanted(record)]
+
+
+def ordered_map(pool, fn, items, ahead):
+    # Like pool.map but with at most 'ahead' items in flight, so a long
+    # generator of items is not read all at once
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def parallel_records(path, jobs):
+    if path.endswith(('.gz', '.bz2')):
+        shards = compressed_blocks(path)
+    else:
+        n_shards = max(jobs, -(-os.path.getsize(path) // SHARD_BYTES))
+        offsets = shard_offsets(path, n_shards)
+        shards = [(path, start, end) for start, end in zip(offsets, offsets[1:])]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for records in ordered_map(pool, parse_shard, shards, 2 * jobs):
+            yield from records
+
+
+def write_fasta(record, direct):
+    accession, _, protein_id, translation = record
+    with open(os.path.join(direct, f'{accession}.faa'), 'w') as fasta:
+        fasta.write(f'>{protein_id}\n{translation}')
+
+
+def sequence_hash(translation):
+    return hashlib.sha256(translation.encode()).hexdigest()[:32]
+
+
+def dedup_records(records, mapping):
+    # Yields only the records with a translation not seen before, named by the
+    # hash of the translation instead of the accession, and writes a row
+    # mapping every accession to its hash to the mapping CSV file
+    seen = set()
+    with open(mapping, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(MAPPING_COLUMNS)
+        for accession, organism, protein_id, translation in records:
+            seq_hash = sequence_hash(translation)
+            writer.writerow([accession, protein_id, organism, seq_hash])
+            if seq_hash not in seen:
+                seen.add(seq_hash)
+                yield seq_hash, organism, protein_id, translation
+    print(f'{len(seen)} distinct translations, accessions mapped to them in {mapping}')
+
+
+def get_data4fasta(file, dire, jobs=1, fastafile=None, mapping=None):
+    # Writes one FASTA file per human or mouse entry with a translation, or
+    # with fastafile all of them to one indexed multi-FASTA file. With mapping
+    # each distinct translation is written once
+    if jobs > 1:
+        records = parallel_records(file, jobs)
+    else:
+        records = filter(wanted, read_embl_records(file))
+    if mapping is not None:
+        records = dedup_records(records, mapping)
+    if fastafile is not None:
+        n_records = faidx_shm.write_indexed_fasta(((accession, protein_id, translation)
+                                                   for accession, _, protein_id, translation in records), fastafile)
+        print(f'{n_records} records written to {fastafile} and {faidx_shm.index_path(fastafile)}')
+        return
+    for record in records:
+        write_fasta(record, dire)
     return
 
 
@@ -107,22 +290,31 @@ SQ   Sequence 840 BP; 157 A; 227 C; 265 G; 191 T; 0 other;
      agtggccggg ggttctttga cttctggggc cagggaaccc tggtcaccgt ctcctcatga       840
 //
 """
-    expected_output = ['AC   JA013192;', 'FT                   /organism="Homo sapiens"', 
-                       'FT                   /protein_id="CCA61653.1"', 
-                       'FT                   /translation="MWWRLWWLLLLLLLLWPMVWADIVLTQSPGTLSLSAGERATLSCR',
-                       'FT                   ASQSVSSGSLAWYQQKPGQAPRLLIYGASTRATGIPDRFSGSGSGTDFTLTIGRLEPED', 
-                       'FT                   LAVYYCQQYGTSPYTFGQGTKVDIKRGGGGSGGGGSGGGGSRSSQVQLVQSGAEVKKPG', 
-                       'FT                   SSVQVSCKASGGTFSMYGFNWVRQAPGHGLEWMGGIIPIFGTSNYAQKFRGRVTFTADQ', 
-                       'FT                   ATSTAYMELTNLRSDDTAVYYCARDFGPDWEDGDSYDGSGRGFFDFWGQGTLVTVSS"']
-
+    expected_output = [('JA013192', 'Homo sapiens', 'CCA61653.1',
+                        'MWWRLWWLLLLLLLLWPMVWADIVLTQSPGTLSLSAGERATLSCR'
+                        'ASQSVSSGSLAWYQQKPGQAPRLLIYGASTRATGIPDRFSGSGSGTDFTLTIGRLEPED'
+                        'LAVYYCQQYGTSPYTFGQGTKVDIKRGGGGSGGGGSGGGGSRSSQVQLVQSGAEVKKPG'
+                        'SSVQVSCKASGGTFSMYGFNWVRQAPGHGLEWMGGIIPIFGTSNYAQKFRGRVTFTADQ'
+                        'ATSTAYMELTNLRSDDTAVYYCARDFGPDWEDGDSYDGSGRGFFDFWGQGTLVTVSS')]
+    records = list(parse_embl_records(test_input.splitlines(keepends=True)))
+    utils_shm.check_equal(records, expected_output)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Compile.....')
     parser.add_argument(
-        '--emblfile', help='EMBL file', required=True)
+        '--emblfile', help='EMBL file, which may be gzip (.gz) or bzip2 (.bz2) compressed', required=True)
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument(
+        '--newfastadir', help='Directory for location of new fasta files')
+    output.add_argument(
+        '--fastafile', help='Write all the sequences to this multi-FASTA file, with a .fai index, instead')
+    parser.add_argument(
+        '--jobs', help='Number of processes parsing the file', type=int, default=1)
     parser.add_argument(
-        '--newfastadir', help='Directory for location of new fasta files', required=True)
+        '--mapping', help='Write each distinct translation once, named by its hash, and a table of the hash of '
+                          'every accession to this CSV file')
     args = parser.parse_args()
 
-    get_data4fasta(args.emblfile, args.newfastadir)
\ No newline at end of file
+    run_test_get_data4fasta()
+    get_data4fasta(args.emblfile, args.newfastadir, args.jobs, args.fastafile, args.mapping)
\ No newline at end of file
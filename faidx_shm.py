@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# Multi-FASTA files with a samtools-style .fai index.
+#
+# Many sequences are kept in one FASTA file instead of one small file each.
+# The index next to it, <file>.fai, has a tab separated line per record:
+#
+#   NAME  LENGTH  OFFSET  LINEBASES  LINEWIDTH
+#
+# NAME is the first word of the header, OFFSET the byte offset of the first
+# residue, LINEBASES the residues on each full line and LINEWIDTH the bytes on
+# each full line including the newline. A record is read with one seek, and
+# the files can also be used with 'samtools faidx'.
+#
+# Usage: faidx_shm.py antibodies.faa [NAME ...]
+
+import argparse
+import os
+import tempfile
+import tools_shm
+import utils_shm
+from functools import lru_cache
+
+LINE_BASES = 60
+
+
+def index_path(path):
+    return path + '.fai'
+
+
+def is_indexed_fasta(path):
+    return os.path.isfile(path) and os.path.isfile(index_path(path))
+
+
+def write_indexed_fasta(records, path, line_bases=LINE_BASES):
+    # records gives (name, description, sequence) tuples. Records with a name
+    # already written are skipped, as the index needs unique names. Returns the
+    # number of records written
+    names = set()
+    offset = 0
+    with open(path, 'wb') as fasta, open(index_path(path), 'w') as fai:
+        for name, description, sequence in records:
+            if name in names:
+                print(f'Skipping repeated record {name}')
+                continue
+            names.add(name)
+            header = f'>{name} {description}\n' if description else f'>{name}\n'
+            offset += fasta.write(header.encode())
+            fai.write(f'{name}\t{len(sequence)}\t{offset}\t{line_bases}\t{line_bases + 1}\n')
+            lines = [sequence[i:i + line_bases] for i in range(0, len(sequence), line_bases)]
+            offset += fasta.write(''.join(line + '\n' for line in lines).encode())
+    return len(names)
+
+
+def build_index(path):
+    # Writes the .fai index of an existing FASTA file whose records have
+    # lines of the same length, apart from the last line of each
+    entries = []
+    name = None
+
+    def finish():
+        widths = [len(line) for line in seq_lines]
+        bases = [len(line.rstrip(b'\r\n')) for line in seq_lines]
+        if len(set(widths[:-1])) > 1 or (len(bases) > 1 and bases[-1] > bases[0]):
+            raise ValueError(f'Record {name} in {path} has lines of different lengths')
+        entries.append(f'{name}\t{sum(bases)}\t{start}\t{bases[0] if bases else 0}\t{widths[0] if widths else 0}\n')
+
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    finish()
+                name = (line[1:].split() or [b''])[0].decode()
+                seq_lines = []
+                start = offset + len(line)
+            elif name is not None and line.strip():
+                seq_lines.append(line)
+            offset += len(line)
+    if name is not None:
+        finish()
+    with open(index_path(path), 'w') as fai:
+        fai.writelines(entries)
+
+
+@lru_cache(maxsize=None)
+def read_index(path):
+    # Returns {name: (length, offset, line bases, line width)} in file order
+    index = {}
+    with open(index_path(path), 'r') as fai:
+        for line in fai:
+            fields = line.rstrip('\n').split('\t')
+            index[fields[0]] = tuple(int(field) for field in fields[1:5])
+    return index
+
+
+def fetch_sequence(path, name):
+    length, offset, line_bases, line_width = read_index(path)[name]
+    if line_bases == 0:
+        return ''
+    n_bytes = (length // line_bases) * line_width + length % line_bases
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(n_bytes)
+    return data.decode().replace('\n', '').replace('\r', '')
+
+
+def fetch_record(path, name):
+    # The record as FASTA text, for tools that read a FASTA file
+    return f'>{name}\n{fetch_sequence(path, name)}\n'
+
+
+def sequential_records(path):
+    # {name: sequence} read from the start of the file, without the index
+    return {header[1:].split()[0]: ''.join(lines) for header, lines in tools_shm.read_fasta_records(path)}
+
+
+def run_test_write_and_fetch():
+    # Sequences shorter than, as long as and longer than a line, an empty
+    # one and a repeated name that is skipped
+    records = [('a', 'first', 'EVQL'), ('b', '', 'EVQLVQS'), ('c', 'third one', 'EVQLVQSGAEVKKPGAS'),
+               ('d', '', ''), ('a', 'again', 'QVQL')]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'written.faa')
+        utils_shm.check_equal(write_indexed_fasta(records, path, line_bases=7), 4)
+        expected = sequential_records(path)
+        utils_shm.check_equal(expected, {'a': 'EVQL', 'b': 'EVQLVQS', 'c': 'EVQLVQSGAEVKKPGAS', 'd': ''})
+        utils_shm.check_equal({name: fetch_sequence(path, name) for name in read_index(path)}, expected)
+        utils_shm.check_equal(fetch_record(path, 'c'), '>c\nEVQLVQSGAEVKKPGAS\n')
+
+
+def run_test_build_index():
+    # A file written elsewhere, with Windows line ends and a blank line
+    text = '>x desc\r\nACDEF\r\nGHIKL\r\nMN\r\n\r\n>y\r\nPQRST\r\n>z\r\nVWY\r\n'
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'built.faa')
+        with open(path, 'w', newline='') as f:
+            f.write(text)
+        build_index(path)
+        expected = sequential_records(path)
+        utils_shm.check_equal(list(read_index(path)), ['x', 'y', 'z'])
+        utils_shm.check_equal({name: fetch_sequence(path, name) for name in read_index(path)}, expected)
+
+        uneven = os.path.join(directory, 'uneven.faa')
+        with open(uneven, 'w') as f:
+            f.write('>x\nACD\nEFGHI\nK\n')
+        try:
+            build_index(uneven)
+            rejected = False
+        except ValueError:
+            rejected = True
+        utils_shm.check_equal(rejected, True)
+
+
+# *************************************************************************
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Print records of a multi-FASTA file, indexing it first if it has no .fai index')
+    parser.add_argument('fasta', help='Multi-FASTA file')
+    parser.add_argument('names', nargs='*', help='Records to print (all if none are given)')
+    args = parser.parse_args()
+
+    run_test_write_and_fetch()
+    run_test_build_index()
+
+    if not os.path.exists(index_path(args.fasta)):
+        build_index(args.fasta)
+    for record_name in args.names or read_index(args.fasta):
+        print(fetch_record(args.fasta, record_name), end='')
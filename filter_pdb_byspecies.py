@@ -6,6 +6,8 @@ import os
 import shutil
 import pandas as pd
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 
 def pairwise(iterable):
@@ -23,46 +25,43 @@ def make_list_of_files(dire):
     return files
 
 
-def map_molid_chain(dire, file):
-        rel_lines = []
-        chain_data = {}
-        with open(os.path.join(dire, file), 'r') as f:
-            for line in f:
-                if line.startswith('COMPND'):
-                    split_line = line.split()
-                    if 'MOL_ID:' in line or 'CHAIN:' in split_line[2]:
-                        # print(split_line)
-                        line_s = line.split(':')
-                        info = line_s[1].replace(';', '')
-                        rel_lines.append(info.strip())
-        for x, y in pairwise(rel_lines):
-            chain_data[x] = y
-        return chain_data
-
-
-def map_molid_org(dire, file):
-        prev = ''
-        org_list = []
-        with open(os.path.join(dire, file), 'r') as f:
-            for line in f:
-                if line.startswith('SOURCE'):
-                    for term in ['MOL_ID:', 'ORGANISM_SCIENTIFIC:']:
-                        if term in line:
-                            # print(line)
-                            if prev == term:
-                                # print('missing line...')
-                                org_list.append(None)
-                            line_s = line.split(':')
-                            info = line_s[1].replace(';', '').strip()
-                            org_list.append(info)
-                            prev = term
-            if prev == 'MOL_ID:':
-                org_list.append(None)
-        # print(org_list)
-        org_data = {}
-        for x, y in pairwise(org_list):
-            org_data[x] = y
-        return org_data
+# COMPND and SOURCE records are only in the header, so a file is read up to
+# the first of these records
+COORDINATE_RECORDS = ('ATOM', 'HETATM', 'MODEL')
+
+
+def scan_header(dire, file):
+    # Reads the header once and returns ({MOL_ID: CHAIN}, {MOL_ID: ORGANISM_SCIENTIFIC})
+    compnd_lines = []
+    org_list = []
+    prev = ''
+    with open(os.path.join(dire, file), 'r') as f:
+        for line in f:
+            if line.startswith('COMPND'):
+                split_line = line.split()
+                if 'MOL_ID:' in line or 'CHAIN:' in split_line[2]:
+                    info = line.split(':')[1].replace(';', '')
+                    compnd_lines.append(info.strip())
+            elif line.startswith('SOURCE'):
+                for term in ['MOL_ID:', 'ORGANISM_SCIENTIFIC:']:
+                    if term in line:
+                        # A molecule without an organism
+                        if prev == term:
+                            org_list.append(None)
+                        info = line.split(':')[1].replace(';', '').strip()
+                        org_list.append(info)
+                        prev = term
+            elif line.startswith(COORDINATE_RECORDS):
+                break
+    if prev == 'MOL_ID:':
+        org_list.append(None)
+    chain_data = {}
+    for x, y in pairwise(compnd_lines):
+        chain_data[x] = y
+    org_data = {}
+    for x, y in pairwise(org_list):
+        org_data[x] = y
+    return chain_data, org_data
 
 
 def combine_dicts(dict1, dict2):
@@ -73,27 +72,36 @@ def combine_dicts(dict1, dict2):
     return dd
 
 
-def map_chain_org(dire, files):
+def chain_species(dire, file):
+    chain_dict, org_dict = scan_header(dire, file)
+    final_dict = combine_dicts(chain_dict, org_dict)
+    summary = [file[:-4]]
+    l_chain = []
+    h_chain = []
+    for value in final_dict.values():
+        if 'L' in value[0]:
+            l_chain.append(value[1])
+        if 'H' in value[0]:
+            h_chain.append(value[1])
+    if len(h_chain) == 0:
+        h_chain.append(None)
+    if len(l_chain) == 0:
+        l_chain.append(None)
+    return summary + h_chain + l_chain
+
+
+def map_chain_org(dire, files, jobs=1):
     lh_chain_species = []
-    for file in files:
-        print(file)
-        chain_dict = map_molid_chain(dire, file)
-        org_dict = map_molid_org(dire, file)
-        final_dict = combine_dicts(chain_dict, org_dict)
-        summary = [file[:-4]]
-        l_chain = []
-        h_chain = []
-        for value in final_dict.values():
-            if 'L' in value[0]:
-                l_chain.append(value[1])
-            if 'H' in value[0]:
-                h_chain.append(value[1])
-        if len(h_chain) == 0:
-            h_chain.append(None)
-        if len(l_chain) == 0:
-            l_chain.append(None)
-        summary = summary + h_chain + l_chain
-        lh_chain_species.append(summary)
+    if jobs <= 1:
+        for file in files:
+            print(file)
+            lh_chain_species.append(chain_species(dire, file))
+        return lh_chain_species
+    # The results of the pool come back in the order of files
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for file, summary in zip(files, pool.map(chain_species, repeat(dire), files, chunksize=64)):
+            print(file)
+            lh_chain_species.append(summary)
     return lh_chain_species
  
 
@@ -106,14 +114,18 @@ def make_df(data):
 
 
 def make_human_mouse_dirs(hm_list, ent_dir, pdb_dir, fasta_dir):
+    # Each directory is listed once rather than once per file
+    dir_files = {}
+
     def copy_files(file_type, full_dir, hm_file):
         new_dir = f'{file_type}_human_mouse'
         try:
             os.mkdir(new_dir)
         except:
             pass
-        files = make_list_of_files(full_dir)
-        for file in files:
+        if full_dir not in dir_files:
+            dir_files[full_dir] = make_list_of_files(full_dir)
+        for file in dir_files[full_dir]:
             if hm_file in file:
                 src = os.path.join(full_dir, file)
                 dst = os.path.join(new_dir, file)
@@ -138,9 +150,11 @@ if __name__ == '__main__':
         '--pdbdir', help='.', required=True)
     parser.add_argument(
         '--fastadir', help='.', required=True)
+    parser.add_argument(
+        '--jobs', help='Number of processes reading the .ent files', type=int, default=1)
     args = parser.parse_args()
 
     file_list = make_list_of_files(args.entdir)
-    chain_spec = map_chain_org(args.entdir, file_list)
+    chain_spec = map_chain_org(args.entdir, file_list, args.jobs)
     hm_file_list = make_df(chain_spec)
     make_human_mouse_dirs(hm_file_list, args.entdir, args.pdbdir, args.fastadir)
\ No newline at end of file
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+# In-process germline assignment, giving the same fields as agl -a.
+#
+# The V and J germline protein sequences (human and mouse) are loaded once from
+# FASTA files. IMGT style headers are understood:
+#
+#   >X01234|IGHV1-3*01|Homo sapiens|F|V-REGION|...
+#
+# otherwise the first word of the header is taken as the gene name.
+#
+# For each gene group (e.g. heavy chain V genes) a k-mer index maps every k-mer
+# to the genes and positions it occurs at. A query votes for (gene, diagonal)
+# pairs through its k-mers, the best voted genes are shortlisted, and the
+# shortlist is scored together as one ungapped comparison against the query at
+# each gene's best diagonal.
+#
+# Usage: germline_shm.py --germlines human.faa mouse.faa --faa file.faa
+
+import argparse
+import os
+import re
+import tempfile
+import numpy as np
+
+import tools_shm
+import utils_shm
+
+NO_RESIDUE = 255
+CHAIN_TYPES = {'H': 'Heavy', 'L': 'Light'}
+
+
+def parse_header(header):
+    fields = header[1:].strip().split('|')
+    if len(fields) >= 3:
+        gene = fields[1].strip()
+        species = fields[2].strip()
+        functionality = fields[3].strip() if len(fields) > 3 else ''
+    else:
+        gene = fields[0].split()[0]
+        species = ''
+        functionality = ''
+    return gene, species, functionality
+
+
+def gene_group(gene):
+    # IGHV1-3*01 -> ('H', 'V'); IGKJ2*01 -> ('L', 'J')
+    match = re.match(r'IG([HKL])([VJ])', gene)
+    if match is None:
+        raise ValueError(f'Germline gene name {gene} is not an IMGT IG[HKL][VJ] name')
+    chain = 'H' if match.group(1) == 'H' else 'L'
+    return chain, match.group(2)
+
+
+class GermlineSet:
+    # The genes of one chain and segment, with their k-mer index
+    def __init__(self, genes, k):
+        self.k = k
+        self.names = [g[0] for g in genes]
+        self.species = [g[1] for g in genes]
+        self.functionality = [g[2] for g in genes]
+        self.seqs = [g[3] for g in genes]
+        self.codes = [utils_shm.encode_residues(s) for s in self.seqs]
+        self.max_len = max(len(s) for s in self.seqs)
+
+        index = {}
+        for gene_idx, codes in enumerate(self.codes):
+            for pos, kmer in enumerate(self.kmers(codes)):
+                index.setdefault(kmer, []).append((gene_idx, pos))
+        self.index = {kmer: np.array(hits, dtype=np.int32) for kmer, hits in index.items()}
+
+    def kmers(self, codes):
+        # Each k-mer packed into one integer (base 32)
+        if len(codes) < self.k:
+            return np.zeros(0, dtype=np.int64)
+        windows = np.lib.stride_tricks.sliding_window_view(codes.astype(np.int64), self.k)
+        return windows @ (32 ** np.arange(self.k - 1, -1, -1))
+
+    def best(self, query, shortlist=20):
+        # Returns (gene index, offset of gene start in the query, matches,
+        # aligned length) for the best gene, or None
+        hits = [(self.index[kmer], qpos) for qpos, kmer in enumerate(self.kmers(query))
+                if kmer in self.index]
+        if not hits:
+            return None
+        genes = np.concatenate([h[:, 0] for h, _ in hits])
+        diagonals = np.concatenate([qpos - h[:, 1] for h, qpos in hits])
+        shift = self.max_len
+        n_diag = len(query) + self.max_len + 1
+        votes = np.bincount(genes * n_diag + diagonals + shift,
+                            minlength=len(self.names) * n_diag).reshape(len(self.names), n_diag)
+        best_diag = votes.argmax(axis=1)
+        candidates = np.argsort(-votes.max(axis=1), kind='stable')[:shortlist]
+        candidates = candidates[votes[candidates, best_diag[candidates]] > 0]
+
+        # Lay each candidate gene under the query at its best diagonal
+        width = len(query)
+        laid = np.full((len(candidates), width), NO_RESIDUE, dtype=np.uint8)
+        for row, gene_idx in enumerate(candidates):
+            offset = best_diag[gene_idx] - shift
+            codes = self.codes[gene_idx]
+            start = max(offset, 0)
+            end = min(offset + len(codes), width)
+            if end > start:
+                laid[row, start:end] = codes[start - offset:end - offset]
+        covered = laid != NO_RESIDUE
+        matches = ((laid == query[None, :]) & covered).sum(axis=1)
+        lengths = covered.sum(axis=1)
+        order = np.lexsort((lengths - matches, -matches))
+        row = order[0]
+        gene_idx = candidates[row]
+        return gene_idx, int(best_diag[gene_idx] - shift), int(matches[row]), int(lengths[row])
+
+
+class GermlineDB:
+    def __init__(self, paths, species=None, k=4):
+        groups = {}
+        for path in paths:
+            for header, seq in tools_shm.read_fasta_records(path):
+                gene, gene_species, functionality = parse_header(header)
+                if species is not None and gene_species and species not in gene_species:
+                    continue
+                seq = ''.join(seq).replace('.', '').replace('-', '').upper()
+                groups.setdefault(gene_group(gene), []).append((gene, gene_species, functionality, seq))
+        self.sets = {group: GermlineSet(genes, k) for group, genes in groups.items()}
+
+    def assign_segment(self, seq, chain, segment, start=0):
+        # Returns the agl fields for the best gene of one segment type, or None.
+        # The search starts at 'start' so that J genes are looked for after the V gene
+        gset = self.sets.get((chain, segment))
+        if gset is None:
+            return None
+        query = utils_shm.encode_residues(seq[start:].upper())
+        best = gset.best(query)
+        if best is None:
+            return None
+        gene_idx, offset, matches, length = best
+        germline = gset.seqs[gene_idx]
+        q_start = max(offset, 0)
+        q_end = min(offset + len(germline), len(query))
+        aligned_input = seq[start + q_start:start + q_end]
+        aligned_germline = germline[q_start - offset:q_end - offset]
+        return {'segment': f'{segment}{chain}',
+                'gene': gset.names[gene_idx],
+                'species': gset.species[gene_idx],
+                'functionality': gset.functionality[gene_idx],
+                'identity': 100.0 * matches / length,
+                'mismatches': length - matches,
+                'input': aligned_input,
+                'germline': aligned_germline,
+                'end': start + q_end}
+
+    def assign_chain(self, seq):
+        # Chooses heavy or light from the better scoring V gene
+        best_v = None
+        for chain in ['L', 'H']:
+            v = self.assign_segment(seq, chain, 'V')
+            if v is not None and (best_v is None or
+                                  len(v['input']) - v['mismatches'] > len(best_v['input']) - best_v['mismatches']):
+                best_v = v
+        if best_v is None:
+            return None, []
+        chain = best_v['segment'][1]
+        j = self.assign_segment(seq, chain, 'J', best_v['end'])
+        if j is None:
+            # Every chain has a V and a J entry, as runAGL reads the
+            # Mismatches lines by position
+            j = no_segment(chain, 'J')
+        return chain, [best_v, j]
+
+
+def no_segment(chain, segment):
+    # Stands in for a gene that could not be assigned, with no mismatches
+    return {'segment': f'{segment}{chain}', 'gene': '-', 'species': '', 'functionality': '',
+            'identity': 0.0, 'mismatches': 0, 'input': '', 'germline': '', 'end': None}
+
+
+def format_segment(s):
+    match_line = ''.join('|' if a == b else ' ' for a, b in zip(s['input'], s['germline']))
+    return (f"{s['segment']}      : {s['identity']:6.2f}% : {s['gene']:<12} : {s['functionality']} : {s['species']}\n"
+            f"    {s['input']}\n"
+            f"    {match_line}\n"
+            f"    {s['germline']}\n"
+            f"    Mismatches: {s['mismatches']}\n")
+
+
+def assign_records(records, db):
+    # Returns the same text as agl -a for a list of [header, sequence lines]
+    out = []
+    for header, seq in records:
+        chain, segments = db.assign_chain(''.join(seq))
+        out.append(f'{header}\n')
+        if chain is None:
+            continue
+        out.append(f'# Chain type: {CHAIN_TYPES[chain]}\n')
+        out.append('\n'.join(format_segment(s) for s in segments))
+        out.append('\n')
+    return ''.join(out)
+
+
+def assign_file(path, db):
+    return assign_records(tools_shm.read_fasta_records(path), db)
+
+
+def run_test_assign_chain_example():
+    # The VL/VH example at the top of hydrophob_changes.py, with one other
+    # gene of each group to choose against
+    genes = [('IGKV3-20*01', 'EIVLTQSPGTLSLSPGERATLSCRASQSVSSSYLAWYQQKPGQAPRLLIYGASSRATGIPDRFSGSGSGTDFTLTISRLEPEDF'
+                             'AVYYCQQYGSSP'),
+             ('IGKV1-39*01', 'DIQMTQSPSSLSASVGDRVTITCRASQSISSYLNWYQQKPGKAPKLLIYAASSLQSGVPSRFSGSGSGTDFTLTISSLQPEDF'
+                             'ATYYCQQSYSTP'),
+             ('IGKJ2*01', 'YTFGQGTKLEIK'),
+             ('IGKJ1*01', 'WTFGQGTKVEIK'),
+             ('IGHV1-3*01', 'QVQLVQSGAEVKKPGASVKVSCKASGYTFTSYAMHWVRQAPGQRLEWMGWINAGNGNTKYSQKFQGRVTITRDTSASTAYMEL'
+                            'SSLRSEDTAVYYCAR'),
+             ('IGHV3-23*01', 'EVQLLESGGGLVQPGGSLRLSCAASGFTFSSYAMSWVRQAPGKGLEWVSAISGSGGSTYYADSVKGRFTISRDNSKNTLYLQM'
+                             'NSLRAEDTAVYYCAK'),
+             ('IGHJ6*03', 'YYYYYYMDVWGKGTTVTVSS'),
+             ('IGHJ4*02', 'YFDYWGQGTLVTVSS')]
+    light = ('EIVLTQSPGTLSLSPGERATFSCRSSHSIRSRRVAWYQHKPGQAPRLVIHGVSNRASGISDRFSGSGSGTDFTLTITRVEPEDFALYYCQVYGASS'
+             'YTFGQGTKLERK')
+    heavy = ('QVQLVQSGAEVKKPGASVKVSCQASGYRFSNFVIHWVRQAPGQRFEWMGWINPYNGNKEFSAKFQDRVTFTADTSANTAYMELRSLRSADTAVYYCAR'
+             'PQDNYYMDVWGKGTTVIVSS')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'germlines.faa')
+        with open(path, 'w') as f:
+            for gene, seq in genes:
+                f.write(f'>X|{gene}|Homo sapiens|F|\n{seq}\n')
+        db = GermlineDB([path])
+
+    def fields(segment):
+        return [segment['segment'], segment['gene'], round(segment['identity'], 2), segment['mismatches'],
+                segment['input'], segment['germline']]
+
+    chain, segments = db.assign_chain(light)
+    utils_shm.check_equal([chain] + [fields(s) for s in segments], [
+        'L',
+        ['VL', 'IGKV3-20*01', 78.12, 21, light[:96], genes[0][1]],
+        ['JL', 'IGKJ2*01', 91.67, 1, 'YTFGQGTKLERK', 'YTFGQGTKLEIK']])
+    chain, segments = db.assign_chain(heavy)
+    utils_shm.check_equal([chain] + [fields(s) for s in segments], [
+        'H',
+        ['VH', 'IGHV1-3*01', 79.59, 20, heavy[:98], genes[4][1]],
+        ['JH', 'IGHJ6*03', 75.0, 5, 'PQDNYYMDVWGKGTTVIVSS', 'YYYYYYMDVWGKGTTVTVSS']])
+
+
+def run_test_gene_group():
+    utils_shm.check_equal([gene_group('IGHV1-3*01'), gene_group('IGKJ2*01'), gene_group('IGLV2-14*01')],
+                          [('H', 'V'), ('L', 'J'), ('L', 'V')])
+    try:
+        gene_group('TRBV5-1*01')
+        rejected = False
+    except ValueError:
+        rejected = True
+    utils_shm.check_equal(rejected, True)
+
+
+# *************************************************************************
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Assign V and J germline genes without running agl')
+    parser.add_argument(
+        '--germlines', help='FASTA files of V and J germline protein sequences', nargs='+', required=True)
+    parser.add_argument(
+        '--species', help='Only use germlines from this species (e.g. Homo or Mus)')
+    parser.add_argument('--faa', help='FASTA files to assign', nargs='+', required=True)
+    args = parser.parse_args()
+
+    run_test_assign_chain_example()
+    run_test_gene_group()
+
+    germline_db = GermlineDB(args.germlines, args.species)
+    for file in args.faa:
+        print(assign_file(file, germline_db))
@@ -3,91 +3,307 @@
 # Import libraries
 
 import os
+import matplotlib
+# Figures are only ever written to files, so no display is needed
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.colors import LogNorm
 from matplotlib.ticker import MaxNLocator
 import seaborn as sns
 
 
 # *************************************************************************
-def mutations_vs_angrange(df, mut_column, x_axis, directory, name, max_val_df):
-    # Plot all data
-    # .corr() returns the correlation between two columns
-    pearson_max = df[mut_column].corr(max_val_df['max_angle_range'])
-    pearson_all = df[mut_column].corr(df['angle_range'])
+# Rendering
+#
+# Each figure is described by a plot spec, (draw function name, output path,
+# keyword arguments), where the draw function draws onto a given Axes. The
+# specs are rendered by a pool of processes; each process draws all of its
+# figures on one Figure that is cleared after every save, so memory does not
+# grow with the number of figures. Functions that take a 'specs' list add
+# their specs to it and leave the rendering to the caller, so that the figures
+# from several functions can share one pool.
 
-    plt.figure()
+_figure = None
 
-    color_all = 'burlywood'
-    color_top = 'rebeccapurple'
 
-    x_all = df[mut_column]
-    y_all = df['angle_range']
+def render(spec):
+    global _figure
+    draw, path, kwargs = spec
+    if _figure is None:
+        _figure = plt.figure()
+    ax = _figure.add_subplot()
+    try:
+        globals()[draw](ax, **kwargs)
+        _figure.savefig(path, format=os.path.splitext(path)[1][1:])
+    finally:
+        _figure.clf()
+    return path
+
+
+def render_specs(specs, jobs=None):
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1 or len(specs) <= 1:
+        for spec in specs:
+            render(spec)
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(specs))) as pool:
+            list(pool.map(render, specs))
+
+
+# *************************************************************************
+# Aggregation
+#
+# For very large tables the points are not drawn one by one. The data are read
+# as an iterable of (x, y) chunks, for example pd.read_csv(..., chunksize=...),
+# so only one chunk is in memory at a time. Each chunk is added to a fixed grid
+# of 2D histogram counts, whose ranges must therefore be known up front, and
+# to the statistics (n, mean x, mean y, Sxx, Syy, Sxy), where the S terms are
+# sums of products of deviations from the means. Chunks are merged with Chan's
+# parallel update, which keeps the sums centred and so avoids the cancellation
+# of the raw sum-of-squares formulas. The least squares line and Pearson
+# correlation follow from these, and the figures are drawn from the counts,
+# so drawing time depends on the number of bins and not on the number of rows.
+
+AGGREGATE_MODES = ['hist2d', 'hexbin']
+CHUNK_ROWS = 1 << 20
+
+
+def array_chunks(x, y, chunk=CHUNK_ROWS):
+    # (x, y) chunks of arrays or Series already in memory
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    for start in range(0, len(x), chunk):
+        yield x[start:start + chunk], y[start:start + chunk]
+
+
+def data_ranges(x, y):
+    # Histogram ranges covering the finite values of x and y
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    keep = np.isfinite(x) & np.isfinite(y)
+    if not keep.any():
+        return [[0, 1], [0, 1]]
+    ranges = [[x[keep].min(), x[keep].max()], [y[keep].min(), y[keep].max()]]
+    # A single value still needs a bin of some width
+    return [[low, high] if high > low else [low - 0.5, high + 0.5] for low, high in ranges]
+
 
-    y_max = max_val_df['max_angle_range']
-    x_max = max_val_df[mut_column]
+def merge_stats(a, b):
+    # Chan et al.'s update of (n, mean x, mean y, Sxx, Syy, Sxy) for the union
+    # of two sets of points
+    n_a, mx_a, my_a, sxx_a, syy_a, sxy_a = a
+    n_b, mx_b, my_b, sxx_b, syy_b, sxy_b = b
+    n = n_a + n_b
+    if n == 0:
+        return a
+    dx = mx_b - mx_a
+    dy = my_b - my_a
+    weight = n_a * n_b / n
+    return np.array([n, mx_a + dx * n_b / n, my_a + dy * n_b / n,
+                     sxx_a + sxx_b + dx * dx * weight,
+                     syy_a + syy_b + dy * dy * weight,
+                     sxy_a + sxy_b + dx * dy * weight])
 
-    axes = plt.gca()
+
+def chunk_stats(x, y):
+    n = len(x)
+    if n == 0:
+        return np.zeros(6)
+    dx = x - x.mean()
+    dy = y - y.mean()
+    return np.array([n, x.mean(), y.mean(), dx @ dx, dy @ dy, dx @ dy])
+
+
+def binned_stats(chunks, ranges, bins=100):
+    # chunks gives (x, y) pairs of arrays or Series. Returns (counts, x edges,
+    # y edges, stats). Pairs with a NaN are left out, as pandas' corr() does
+    counts = np.zeros((bins, bins), dtype=np.int64)
+    stats = np.zeros(6)
+    for x, y in chunks:
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        keep = np.isfinite(x) & np.isfinite(y)
+        x = x[keep]
+        y = y[keep]
+        counts += np.histogram2d(x, y, bins=bins, range=ranges)[0].astype(np.int64)
+        stats = merge_stats(stats, chunk_stats(x, y))
+    x_edges = np.linspace(ranges[0][0], ranges[0][1], bins + 1)
+    y_edges = np.linspace(ranges[1][0], ranges[1][1], bins + 1)
+    return counts, x_edges, y_edges, stats
+
+
+def fit_from_stats(stats):
+    # Returns (slope, intercept, pearson r) from (n, mean x, mean y, Sxx, Syy, Sxy)
+    n, mean_x, mean_y, sxx, syy, sxy = stats
+    if n < 2 or sxx <= 0:
+        return np.nan, np.nan, np.nan
+    m = sxy / sxx
+    b = mean_y - m * mean_x
+    r = sxy / np.sqrt(sxx * syy) if syy > 0 else np.nan
+    return m, b, r
+
+
+def draw_density(ax, counts, x_edges, y_edges, mode, cmap):
+    if mode == 'hexbin':
+        # Bin centres weighted by their counts, so matplotlib only sees the grid
+        x_mid = (x_edges[:-1] + x_edges[1:]) / 2
+        y_mid = (y_edges[:-1] + y_edges[1:]) / 2
+        xx, yy = np.meshgrid(x_mid, y_mid, indexing='ij')
+        nonzero = counts > 0
+        if nonzero.any():
+            ax.hexbin(xx[nonzero], yy[nonzero], C=counts[nonzero], reduce_C_function=np.sum,
+                      gridsize=min(len(x_mid), 50), extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]),
+                      bins='log', cmap=cmap, mincnt=1)
+    else:
+        ax.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts, 0).T, cmap=cmap, norm=LogNorm())
+
+
+def draw_fit_line(ax, m, b, x_edges, color, label, x, y):
+    if np.isnan(m):
+        return
+    ends = np.array([x_edges[0], x_edges[-1]])
+    ax.plot(ends, m * ends + b, color=color, linestyle='dashed', linewidth=1)
+    ax.text(s=f'{label}: ' + 'y={:.3f}x+{:.3f}'.format(m, b), x=x, y=y, fontsize=8, color=color)
+
+
+# *************************************************************************
+def draw_mutations_vs_angrange(ax, x_all, y_all, x_max, y_max, x_axis):
+    color_all = 'burlywood'
+    color_top = 'rebeccapurple'
 
     # Sets the maximum and minimum values for the axes
     # axes.autoscale(tight=True)
-    axes.set_xlim([0, 50])
-    axes.set_ylim([-0.5, 20])
+    ax.set_xlim([0, 50])
+    ax.set_ylim([-0.5, 20])
 
     # axes.axline((0, 0), (1, 1), color='k')
 
     # Sets the axes labels
-    plt.xlabel(f'{x_axis} mutations from germline')
-    plt.ylabel('Range of the packing angle')
+    ax.set_xlabel(f'{x_axis} mutations from germline')
+    ax.set_ylabel('Range of the packing angle')
 
     # Adds graph annotations
     # plt.text(s=f'Correlation for max: {pearson_a:.3f}', x=10, y=17, fontsize=8)
 
     # Plot highest values
-    plt.scatter(x_all, y_all, s=3, color=color_all)
-    plt.scatter(x_max, y_max, s=3, color=color_top)
+    ax.scatter(x_all, y_all, s=3, color=color_all)
+    ax.scatter(x_max, y_max, s=3, color=color_top)
 
     m, b = np.polyfit(x_all, y_all, 1)
-    plt.plot(x_all, m * x_all + b, color=color_all,
+    ax.plot(x_all, m * x_all + b, color=color_all,
             linestyle='dashed', linewidth=1)
     bf_line = 'y={:.3f}x+{:.3f}'.format(m, b)
-    plt.text(s=f'Best fit: {bf_line}',
+    ax.text(s=f'Best fit: {bf_line}',
             x=10, y=17, fontsize=8, color=color_all)
     m_max, b_max = np.polyfit(x_max, y_max, 1)
-    plt.plot(x_max, m_max * x_max + b_max, color=color_top,
+    ax.plot(x_max, m_max * x_max + b_max, color=color_top,
             linestyle='dashed', linewidth=1)
     bf_line_max = 'y={:.3f}x+{:.3f}'.format(m_max, b_max)
-    plt.text(s=f'Best fit for max values: {bf_line_max}',
+    ax.text(s=f'Best fit for max values: {bf_line_max}',
             x=10, y=15, fontsize=8, color=color_top)
 
+
+def draw_aggregated_vs_angrange(ax, counts, x_edges, y_edges, mode, fit_all, fit_max, x_max, y_max, x_axis):
+    color_all = 'burlywood'
+    color_top = 'rebeccapurple'
+
+    ax.set_xlim([0, 50])
+    ax.set_ylim([-0.5, 20])
+    ax.set_xlabel(f'{x_axis} mutations from germline')
+    ax.set_ylabel('Range of the packing angle')
+
+    draw_density(ax, counts, x_edges, y_edges, mode, 'YlOrBr')
+    # There is one maximum per mutation count, so these are few enough to plot
+    ax.scatter(x_max, y_max, s=3, color=color_top)
+    draw_fit_line(ax, fit_all[0], fit_all[1], x_edges, color_all, 'Best fit', 10, 17)
+    draw_fit_line(ax, fit_max[0], fit_max[1], x_edges, color_top, 'Best fit for max values', 10, 15)
+
+
+def mutations_vs_angrange(df, mut_column, x_axis, directory, name, max_val_df, specs=None, aggregate=None,
+                          bins=100):
     # Exports the figure as a .jpg file
     path_fig = os.path.join(directory, f'agl_{name}_{x_axis}_graph.jpg')
-    plt.savefig(path_fig, format='jpg')
-    plt.close()
+    # .corr() returns the correlation between two columns
+    pearson_max = df[mut_column].corr(max_val_df['max_angle_range'])
+    if aggregate is None:
+        # Plot all data
+        pearson_all = df[mut_column].corr(df['angle_range'])
+        spec = ('draw_mutations_vs_angrange', path_fig,
+                {'x_all': df[mut_column].to_numpy(), 'y_all': df['angle_range'].to_numpy(),
+                 'x_max': max_val_df[mut_column].to_numpy(), 'y_max': max_val_df['max_angle_range'].to_numpy(),
+                 'x_axis': x_axis})
+    else:
+        # Binned over the plotted area, with the statistics taken over all the data
+        counts, x_edges, y_edges, stats = binned_stats(array_chunks(df[mut_column], df['angle_range']),
+                                                       [[0, 50], [-0.5, 20]], bins)
+        max_stats = binned_stats(array_chunks(max_val_df[mut_column], max_val_df['max_angle_range']),
+                                 data_ranges(max_val_df[mut_column], max_val_df['max_angle_range']), 1)[3]
+        fit_all = fit_from_stats(stats)
+        fit_max = fit_from_stats(max_stats)
+        pearson_all = fit_all[2]
+        spec = ('draw_aggregated_vs_angrange', path_fig,
+                {'counts': counts, 'x_edges': x_edges, 'y_edges': y_edges, 'mode': aggregate,
+                 'fit_all': fit_all[:2], 'fit_max': fit_max[:2],
+                 'x_max': max_val_df[mut_column].to_numpy(), 'y_max': max_val_df['max_angle_range'].to_numpy(),
+                 'x_axis': x_axis})
+    if specs is None:
+        render_specs([spec], 1)
+    else:
+        specs.append(spec)
 
     print(f'Pearson_all_{x_axis}: {pearson_all} \n Pearson_max_{x_axis}: {pearson_max}')
     # return m, b
     return float(f'{pearson_all:.3f}'), float(f'{pearson_max:.3f}')
 
 
-def hydrophobicity_histagram(x_values, labels, name):
+def draw_hydrophobicity_histogram(ax, x_values, labels):
     n_bins = 20
     color=['teal', 'peachpuff', 'dodgerblue', 'indigo', 'mediumorchid', 'lightpink']
-    plt.figure()
-    plt.hist(x_values, bins=n_bins, density=True, color=color, label=labels)
-    plt.legend(prop={'size': 10})
-    plt.xlabel(f'Mean change in hydrophobicity')
-    plt.ylabel('Frequency')
-    plt.savefig(f'{name}.jpg', format='jpg')
-
-def introduced_hydrophobicity(df):
+    ax.hist(x_values, bins=n_bins, density=True, color=color[:len(labels)], label=labels)
+    ax.legend(prop={'size': 10})
+    ax.set_xlabel(f'Mean change in hydrophobicity')
+    ax.set_ylabel('Frequency')
+
+
+def hydrophobicity_histagram(x_values, labels, name, specs=None):
+    spec = ('draw_hydrophobicity_histogram', f'{name}.jpg', {'x_values': x_values, 'labels': labels})
+    if specs is None:
+        render_specs([spec], 1)
+    else:
+        specs.append(spec)
+
+
+def draw_introduced_hydrophobicity(ax, x, y, color, label_y, pearson_a):
+    ax.scatter(x=x, y=y, s=3, color=color)
+    ax.set_xlabel(f'Number of mutations from germline')
+    ax.set_ylabel(label_y)
+    m, b = np.polyfit(x, y, 1)
+    ax.plot(x, m * x + b, color='black',
+            linestyle='dashed', linewidth=1)
+    bf_line = 'y={:.3f}x+{:.3f}'.format(m, b)
+    ax.text(s=f'Best fit: {bf_line}',
+        x=5, y=8, fontsize=8, color='black')
+    ax.text(s=f'Correlation: {pearson_a}', x=5, y=6, fontsize=8)
+    ax.set_xlim([0, 50])
+    # Fix axes as integer
+    ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+    ax.set_ylim([0, 10])
+    ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+
+
+def introduced_hydrophobicity(df, specs=None):
     print(df)
-    x = df['length_CDRs']
-    y_values = df.drop(['length_CDRs'], axis=1)
+    x = df['mut_count']
+    y_values = df.drop(['mut_count'], axis=1)
 
+    own_specs = specs is None
+    if own_specs:
+        specs = []
     for col in y_values:
-        plt.figure()
         color = ''
         label_y = ''
         if 'hydrophilic' in col:
@@ -96,54 +312,62 @@ def introduced_hydrophobicity(df):
         if 'hydrophobic' in col:
             color = 'maroon'
             label_y = 'Number of hydrophobic residues'
+        if not color:
+            continue
         y = df[col]
-        pearson_a = x.corr(y)
-        plt.scatter(x=x, y=y, s=3, color=color)
-        plt.xlabel(f'Number of mutations from germline')
-        plt.ylabel(label_y)
-        m, b = np.polyfit(x, y, 1)
-        plt.plot(x, m * x + b, color='black',
-                linestyle='dashed', linewidth=1)
-        bf_line = 'y={:.3f}x+{:.3f}'.format(m, b)
-        plt.text(s=f'Best fit: {bf_line}',
-            x=5, y=8, fontsize=8, color='black')
-        plt.text(s=f'Correlation: {pearson_a}', x=5, y=6, fontsize=8)
-        axes = plt.gca()
-        axes.set_xlim([0, 50])
-        # Fix axes as integer
-        axes.xaxis.set_major_locator(MaxNLocator(integer=True))
-        axes.set_ylim([0, 10])
-        axes.yaxis.set_major_locator(MaxNLocator(integer=True))
-        plt.savefig(f'{col}.jpg', format='jpg')
-        plt.close()
-
-
-def introduced_fractional_hydrophobicity(x_values):
+        specs.append(('draw_introduced_hydrophobicity', f'{col}.jpg',
+                      {'x': x.to_numpy(), 'y': y.to_numpy(), 'color': color, 'label_y': label_y,
+                       'pearson_a': x.corr(y)}))
+    if own_specs:
+        render_specs(specs)
+
+
+def draw_fractional_hydrophobicity(ax, values, x_col, color):
+    ax.hist(values, color=color)
+    ax.set_xlabel(f'Fraction of mutations which are {x_col}')
+    ax.set_ylabel('Frequency')
+    ax.set_xlim([0, 1])
+    ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+
+
+def introduced_fractional_hydrophobicity(x_values, specs=None):
     groups = [*range(1, 50, 10)]
     min_max_vals = []
     for i in groups:
         i_int = int(i)
         min_max_vals.append([i_int, i_int+10])
-    
+
+    own_specs = specs is None
+    if own_specs:
+        specs = []
     for min_mut, max_mut in min_max_vals:
         df = x_values[x_values['mut_count'].between(int(min_mut), int(max_mut))]
 
         def make_graph(x_col, color):
-            plt.figure()
-            plt.hist(df[f'fraction_{x_col}'], color=color)
-            plt.xlabel(f'Fraction of mutations which are {x_col}')
-            plt.ylabel('Frequency')
-            axes = plt.gca()
-            axes.set_xlim([0, 1])
-            axes.yaxis.set_major_locator(MaxNLocator(integer=True))
-            plt.savefig(f'{x_col}_{min_mut}_{max_mut}.jpg', format='jpg')
-            plt.close()
-        
+            specs.append(('draw_fractional_hydrophobicity', f'{x_col}_{min_mut}_{max_mut}.jpg',
+                          {'values': df[f'fraction_{x_col}'].to_numpy(), 'x_col': x_col, 'color': color}))
+
         make_graph('hydrophilic', 'turquoise')
         make_graph('hydrophobic', 'maroon')
+    if own_specs:
+        render_specs(specs)
+
+
+def draw_regplot(ax, x, y, y_axis):
+    sns.regplot(y=y, x=x, color='darkturquoise', ax=ax)
+    ax.set(xlabel='mutations from germline', ylabel=y_axis)
 
 
-def hydrophobicity_change_vs_mutation(df):
+def draw_aggregated_regplot(ax, counts, x_edges, y_edges, mode, fit, y_axis):
+    draw_density(ax, counts, x_edges, y_edges, mode, 'GnBu')
+    draw_fit_line(ax, fit[0], fit[1], x_edges, 'darkturquoise', 'Best fit',
+                  x_edges[0] + 0.05 * (x_edges[-1] - x_edges[0]), y_edges[-1] - 0.05 * (y_edges[-1] - y_edges[0]))
+    ax.set_xlim([x_edges[0], x_edges[-1]])
+    ax.set_ylim([y_edges[0], y_edges[-1]])
+    ax.set(xlabel='mutations from germline', ylabel=y_axis)
+
+
+def hydrophobicity_change_vs_mutation(df, specs=None, aggregate=None, bins=100):
     """
         cdr_dY  cdr_dH  cdr_len  cdr_mut  ...  fv_dY  fv_dH  fv_len  fv_mut
     0       1    0.88       39        9  ...      0   2.22     194      25
@@ -151,17 +375,27 @@ def hydrophobicity_change_vs_mutation(df):
     2       0    1.08       39       17  ...      1   0.79     193      26
     3       0   -0.28       39        2  ...      0  -0.12     193       4
     4      -1   -2.97       39       14  ...     -1  -6.04     194      29
+
+    With aggregate ('hist2d' or 'hexbin') the points are binned and the
+    regression line and correlation come from the binned_stats() sums
     """
 
     metrics = []
+    own_specs = specs is None
+    if own_specs:
+        specs = []
 
     def make_graph(x, y, title, y_axis):
-        pearson_r = x.corr(y)
+        if aggregate is None:
+            pearson_r = x.corr(y)
+            specs.append(('draw_regplot', f'{title}.png', {'x': x.to_numpy(), 'y': y.to_numpy(), 'y_axis': y_axis}))
+        else:
+            counts, x_edges, y_edges, stats = binned_stats(array_chunks(x, y), data_ranges(x, y), bins)
+            m, b, pearson_r = fit_from_stats(stats)
+            specs.append(('draw_aggregated_regplot', f'{title}.png',
+                          {'counts': counts, 'x_edges': x_edges, 'y_edges': y_edges, 'mode': aggregate,
+                           'fit': (m, b), 'y_axis': y_axis}))
         metrics.append(pearson_r)
-        ax = sns.regplot(y=y, x=x, color='darkturquoise')
-        ax.set(xlabel='mutations from germline', ylabel=y_axis)
-        plt.savefig(f'{title}.png')
-        plt.clf()
         print(f'Correlation={pearson_r}')
 
     for region in ['cdr', 'fwk', 'fv']:
@@ -169,5 +403,7 @@ def hydrophobicity_change_vs_mutation(df):
         make_graph(df[f'{region}_mut'], df[f'{region}_dY'], f'{region}_dY_graph', 'change in the number of Tyrosines')
         print(f'Graphing region {region} mutations against dH...')
         make_graph(df[f'{region}_mut'], df[f'{region}_dH'], f'{region}_dH_graph', 'change in the hydrophobicity')
+    if own_specs:
+        render_specs(specs)
     
     pd.DataFrame(columns=['cdr_dY', 'cdr_dH', 'fwk_dY', 'fwk_dH', 'fv_dY', 'fv_dH'], data=[metrics]).to_csv('dYdH_pearsons.csv', index=False)
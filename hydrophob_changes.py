@@ -32,38 +32,43 @@
 
 
 import argparse
+import csv
 import os
 import pandas as pd
-import subprocess
 import re
 import graphing_shm as graph
 import utils_shm
+import cache_shm
+import tools_shm
+import align_shm
+import faidx_shm
+import germline_shm
+import profiling_shm
+import regions_shm
 import numpy as np
 from typing import List
 
 
+def list_fasta_files(fastadir):
+    # The records of an indexed multi-FASTA file are named as the files of a
+    # directory would be, '<code>.faa'
+    if faidx_shm.is_indexed_fasta(fastadir):
+        return [f'{name}.faa' for name in faidx_shm.read_index(fastadir)]
+    return os.listdir(fastadir)
+
+
 def run_abnum(file, dire):
-    abnumresult = ''
-    try:
-        path = os.path.join(dire, file)
-        result = (subprocess.check_output(
-            ['abnum', '-f', path])).decode("utf-8")
-        abnumresult = result
-    except subprocess.CalledProcessError:
-        print(f'abnum failed on {file}')
-    return abnumresult
+    if faidx_shm.is_indexed_fasta(dire):
+        # The record is read with a seek and sent to abnum on stdin
+        record = faidx_shm.fetch_record(dire, file[:-4])
+        return tools_shm.run_tool(['abnum', '-f', '/dev/stdin'], None, file, record.encode('utf-8'))
+    path = os.path.join(dire, file)
+    return tools_shm.run_tool(['abnum', '-f', path], path, file)
 
 
-def run_AGL(file, dire):
-    aglresult = ''
-    try:
-        path = os.path.join(dire, file)
-        result = (subprocess.check_output(
-            ['agl', '-d', '-a', path])).decode("utf-8")
-        aglresult = result
-    except subprocess.CalledProcessError:
-        print(f'AGL failed on {file}')
-    return aglresult
+def run_AGL(abnum_seq, name):
+    # The numbered sequence is sent to agl on stdin
+    return tools_shm.run_tool(['agl', '-d', '-a'], None, name, abnum_seq.encode('utf-8'))
 
 
 def parse_abnum_data(num_res):
@@ -90,34 +95,7 @@ def extract_abnum_data(in_file, dire):
 
 
 def label_res_mut(l_muts, h_muts, l_num, h_num):
-    def pair_pos_num_w_res(mut_list, num_list):
-        res = []
-        n = 0
-        m = 0
-        # if len(num_list) == len(mut_list):
-        while n < len(num_list) and m < len(mut_list):
-            if num_list[n][1] == mut_list[m][0]:
-                # print([num_list[n][0], mut_list[m][0], mut_list[m][1]])
-                res.append([num_list[n][0], mut_list[m][0], mut_list[m][1]])
-                n += 1
-                m += 1
-
-        # else:
-        #     'Lists are not the same lenth...'
-            else:
-                for m_search in range(m + 1, len(mut_list)):
-                    if num_list[n][1] == mut_list[m_search][0]:
-                        res.append([num_list[n][0], mut_list[m_search][0], mut_list[m_search][1]])
-                        n += 1
-                        m = m_search + 1
-                        break
-                # else executed if break never happened
-                else:
-                    n += 1
-        return res
-    
-    l_list = pair_pos_num_w_res(l_muts, l_num)
-    h_list = pair_pos_num_w_res(h_muts, h_num)
+    l_list, h_list = align_shm.pair_numbering([l_num, h_num], [l_muts, h_muts])
     return l_list + h_list
 
 def equalize_lists(str_a, str_b, padding = 'X'):
@@ -127,19 +105,62 @@ def equalize_lists(str_a, str_b, padding = 'X'):
     list_b += [padding] * (max(len(list_a), len(list_b)) - len(list_b))
     return list_a, list_b
 
-def char_range(c1, c2):
-    for c in range(ord(c1), ord(c2)+1):
-        yield chr(c)
-
-def extract_mut_data(fastadir):
-    hydrophobicity_class = {'V': 'hydrophobic', 'I': 'hydrophobic', 'F': 'hydrophobic', 'L': 'hydrophobic', 'W': 'hydrophobic', 
-                            'M': 'hydrophobic', 'R': 'hydrophilic', 'K': 'hydrophilic', 'D': 'hydrophilic', 
-                            'Q': 'hydrophilic', 'N': 'hydrophilic', 'E': 'hydrophilic', 'H': 'hydrophilic', 
-                            'S': 'hydrophilic'}
-
+HYDROPHOBICITY_CLASS = {'V': 'hydrophobic', 'I': 'hydrophobic', 'F': 'hydrophobic', 'L': 'hydrophobic', 'W': 'hydrophobic', 
+                        'M': 'hydrophobic', 'R': 'hydrophilic', 'K': 'hydrophilic', 'D': 'hydrophilic', 
+                        'Q': 'hydrophilic', 'N': 'hydrophilic', 'E': 'hydrophilic', 'H': 'hydrophilic', 
+                        'S': 'hydrophilic'}
+
+HYDROPHOBICITY_COLUMNS = ['code','mut_count', 'hydrophilics_all', 'hydrophobics_all', 
+                          'hydrophilics_CDRs', 'hydrophobics_CDRs', 'len_CDRs', 'mut_count_CDRs', 
+                          'hydrophilics_FWk', 'hydrophobics_FWk', 'len_FWk', 'mut_count_framework', 
+                          'hydrophilics_L1', 'hydrophobics_L1', 'len_L1', 'mut_count_L1',
+                          'hydrophilics_L2', 'hydrophobics_L2', 'len_L2', 'mut_count_L2',
+                          'hydrophilics_L3', 'hydrophobics_L3', 'len_L3', 'mut_count_L3',
+                          'hydrophilics_H1', 'hydrophobics_H1', 'len_H1', 'mut_count_H1',
+                          'hydrophilics_H2', 'hydrophobics_H2', 'len_H2', 'mut_count_H2',
+                          'hydrophilics_H3', 'hydrophobics_H3', 'len_H3', 'mut_count_H3']
+
+RESIDUE_COLUMNS = ['code', 'position', 'input', 'germline']
+
+
+def residue_hydrophobicity_table(residues, scheme='default'):
+    # Takes the numbered residues of all antibodies as one table with
+    # RESIDUE_COLUMNS and returns a row of HYDROPHOBICITY_COLUMNS for each
+    # antibody, the same as calc_hydrophobicity_for_loops() gives one antibody
+    # at a time. All the counts come from a single groupby over (code, region)
+    input_class = residues['input'].map(HYDROPHOBICITY_CLASS)
+    germ_class = residues['germline'].map(HYDROPHOBICITY_CLASS)
+    mutated = residues['input'] != residues['germline']
+    counts = pd.DataFrame({'code': residues['code'],
+                           'region': regions_shm.classify(residues['position'], scheme),
+                           'len': 1,
+                           'mut_count': mutated.astype(int),
+                           'hydrophilics': (mutated & (input_class == 'hydrophilic') &
+                                            (germ_class != 'hydrophilic')).astype(int),
+                           'hydrophobics': (mutated & (input_class == 'hydrophobic') &
+                                            (germ_class != 'hydrophobic')).astype(int)})
+    by_region = counts.groupby(['code', 'region'], sort=False).sum().unstack('region', fill_value=0)
+    # Keep the antibodies in the order they were processed
+    by_region = by_region.reindex(pd.unique(residues['code']))
+
+    cdrs = regions_shm.CDRS
+    regions = {'all': cdrs + [regions_shm.FRAMEWORK], 'CDRs': cdrs, 'FWk': [regions_shm.FRAMEWORK]}
+    regions.update({cdr: [cdr] for cdr in cdrs})
+    table = {'code': by_region.index}
+    for region, parts in regions.items():
+        for stat in ['hydrophilics', 'hydrophobics', 'len', 'mut_count']:
+            columns = [(stat, part) for part in parts if (stat, part) in by_region.columns]
+            table[f'{stat}_{region}'] = by_region[columns].sum(axis=1).to_numpy()
+    table['mut_count'] = table.pop('mut_count_all')
+    table['mut_count_framework'] = table.pop('mut_count_FWk')
+    return pd.DataFrame(table)[HYDROPHOBICITY_COLUMNS]
+
+
+def extract_mut_data(fastadir, agl_batch=0, germlines=None, checkpoint='hydrophobicity_checkpoint.csv',
+                     resume=False, columnar=False, scheme='default'):
     def cal_hydrophob_change(df):
-        df['input_class'] = df['input'].map(hydrophobicity_class)
-        df['germ_class'] = df['germline'].map(hydrophobicity_class)
+        df['input_class'] = df['input'].map(HYDROPHOBICITY_CLASS)
+        df['germ_class'] = df['germline'].map(HYDROPHOBICITY_CLASS)
         df_clear = df[df['input_class'] != df['germ_class']]
         induced_hydrophilic = ''
         induced_hydrophobic = ''
@@ -155,18 +176,11 @@ def extract_mut_data(fastadir):
     
     def calc_hydrophobicity_for_loops(df):
         print('Full df:\n', df)
-        cdrL1_pos = [f'L{i}' for i in range(24, 35)]
-        cdrL2_pos = [f'L{i}' for i in range(50, 57)]
-        cdrL3_pos = [f'L{i}' for i in range(89, 98)]
-        cdrH1_pos = [f'H{i}' for i in range(31, 36)]
-        cdrH2_pos = [f'H{i}' for i in range(50, 59)]
-        cdrH3_pos = [f'H{i}' for i in range(95, 103)] + [f'H100{i}' for i in char_range('A', 'K')]
-        cdr_pos = cdrL1_pos + cdrL2_pos + cdrL3_pos + cdrH1_pos + cdrH2_pos + cdrH3_pos
-        fwk_pos = [i for i in df['L/H position'].tolist() if i not in cdr_pos]
-
-        def hydrophob_for_loop(pos_list):
-            print(pos_list)
-            df_loop = df[df['L/H position'].isin(pos_list)]
+        regions = regions_shm.classify(df['L/H position'], scheme)
+
+        def hydrophob_for_loop(region_list):
+            print(region_list)
+            df_loop = df[np.isin(regions, region_list)]
             print(df_loop)
             loop_len = len(df_loop.index)
             df_loop = df_loop[df_loop['input'] != df_loop['germline']]
@@ -174,38 +188,89 @@ def extract_mut_data(fastadir):
             
             return [cal_hydrophob_change(df_loop), loop_len, loop_mut_count]
 
-        dH_l1_data = hydrophob_for_loop(cdrL1_pos)
-        dH_l2_data = hydrophob_for_loop(cdrL2_pos)
-        dH_l3_data = hydrophob_for_loop(cdrL3_pos)
-        dH_h1_data = hydrophob_for_loop(cdrH1_pos)
-        dH_h2_data = hydrophob_for_loop(cdrH2_pos)
-        dH_h3_data = hydrophob_for_loop(cdrH3_pos)
-        dH_all_loops_data = hydrophob_for_loop(cdr_pos)
-        dH_fwk_data = hydrophob_for_loop(fwk_pos)
+        dH_l1_data = hydrophob_for_loop(['L1'])
+        dH_l2_data = hydrophob_for_loop(['L2'])
+        dH_l3_data = hydrophob_for_loop(['L3'])
+        dH_h1_data = hydrophob_for_loop(['H1'])
+        dH_h2_data = hydrophob_for_loop(['H2'])
+        dH_h3_data = hydrophob_for_loop(['H3'])
+        dH_all_loops_data = hydrophob_for_loop(regions_shm.CDRS)
+        dH_fwk_data = hydrophob_for_loop([regions_shm.FRAMEWORK])
         
         return dH_l1_data, dH_l2_data, dH_l3_data, dH_h1_data, dH_h2_data, dH_h3_data, dH_all_loops_data, dH_fwk_data
     
-    files = os.listdir(fastadir)
+    files = list_fasta_files(fastadir)
     tot_files = len(files)
     current_file = 0
-    hydrophob_data = []
-    abnum_fasta_dir = 'fasta_abnum'
-    os.mkdir(abnum_fasta_dir)
 
-    for file in files:
-        print(file)
-        resl, resh = extract_abnum_data(file, fastadir)
+    # Each antibody's row is appended to the checkpoint file as soon as it is
+    # finished, so rows are not held in memory and a stopped run can be resumed.
+    # In columnar mode the checkpoint holds every numbered residue instead, and
+    # the per-antibody rows are worked out for all antibodies at the end
+    columns = RESIDUE_COLUMNS if columnar else HYDROPHOBICITY_COLUMNS
+    rows = []
+    if resume and os.path.exists(checkpoint):
+        with open(checkpoint, 'r', newline='') as f:
+            rows = [row for row in csv.reader(f) if len(row) == len(columns) and all(row)]
+        if not rows or rows[0] != columns:
+            print(f'{checkpoint} was not written in this mode, starting again')
+            rows = []
+    if rows:
+        # The last antibody may have been cut short by a crash, so it is redone
+        last = rows[-1][0] if len(rows) > 1 else None
+        rows = [row for row in rows if row[0] != last]
+        with open(checkpoint, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+        done = set(row[0] for row in rows[1:])
+        files = [file for file in files if file[:-4] not in done]
+        current_file = tot_files - len(files)
+        print(f'Resuming: {current_file} of {tot_files} files already in {checkpoint}')
+    else:
+        with open(checkpoint, 'w', newline='') as f:
+            csv.writer(f).writerow(columns)
+    checkpoint_file = open(checkpoint, 'a', newline='')
+    checkpoint_writer = csv.writer(checkpoint_file)
+
+    def number_antibody(file):
+        # The numbered sequence is kept in memory and handed straight to agl
+        with profiling_shm.stage('abnum'):
+            resl, resh = extract_abnum_data(file, fastadir)
         abnum_seq = ''.join(['>ChainL\n'] + [l[1] for l in resl] + ['\n>ChainH\n'] + [h[1] for h in resh])
-        abnum_file = f'abnum_{file}'
-        abnum_file_path = os.path.join(abnum_fasta_dir, abnum_file)
-        with open(abnum_file_path, 'w') as f:
-            f.write(abnum_seq)
+        return resl, resh, abnum_seq
+
+    germline_db = germline_shm.GermlineDB(germlines) if germlines is not None else None
+    batched = agl_batch > 0 and germline_db is None
+
+    def numbered_files():
+        # In batch mode each chunk of agl_batch files is numbered and sent to
+        # agl at once. Only that chunk is held in memory, and its rows are
+        # written before the next chunk is numbered
+        chunk = agl_batch if batched else 1
+        for start in range(0, len(files), chunk):
+            numbered = {file: number_antibody(file) for file in files[start:start + chunk]}
+            agl_results = {}
+            if batched:
+                print(f'Running agl on {len(numbered)} files...')
+                with profiling_shm.stage('agl'):
+                    agl_results = tools_shm.run_agl_batch_texts({file: seqs[2] for file, seqs in numbered.items()},
+                                                                ['agl', '-d', '-a'], agl_batch)
+            for file, (resl, resh, abnum_seq) in numbered.items():
+                yield file, resl, resh, abnum_seq, agl_results.get(file)
+
+    for file, resl, resh, abnum_seq, result in numbered_files():
+        print(file)
 
         input_L = ''
         germline_L = ''
         input_H = ''
         germline_H = ''
-        result = run_AGL(abnum_file, abnum_fasta_dir)
+        if germline_db is not None:
+            with profiling_shm.stage('germline_assignment'):
+                result = germline_shm.assign_records(tools_shm.parse_fasta_records(abnum_seq.splitlines()),
+                                                     germline_db)
+        elif result is None:
+            with profiling_shm.stage('agl'):
+                result = run_AGL(abnum_seq, file)
         print(result)
         temp = result.replace('\n# ', 'splitter')
         temp = temp.replace('\n\n', 'splitter')
@@ -232,6 +297,12 @@ def extract_mut_data(fastadir):
         print(h_mut)
         
         res_pos_pairs = label_res_mut(l_mut, h_mut, resl, resh)
+        if columnar:
+            checkpoint_writer.writerows([file[:-4]] + pair for pair in res_pos_pairs)
+            checkpoint_file.flush()
+            current_file += 1
+            print(f'Progress: {current_file/tot_files*100:.2f}%')
+            continue
         posres_df = pd.DataFrame(data=res_pos_pairs, columns=['L/H position', 'input', 'germline'])
         print(posres_df)
         mut_df = posres_df[posres_df['input'] != posres_df['germline']]
@@ -242,34 +313,36 @@ def extract_mut_data(fastadir):
         for region in [dh_cdrs, dh_fwk, dh_l1, dh_l2, dh_l3, dh_h1, dh_h2, dh_h3]:
             data.extend([region[0][0], region[0][1], region[1], region[2]])
 
-        hydrophob_data.append(data)
+        checkpoint_writer.writerow(data)
+        checkpoint_file.flush()
         current_file += 1
         print(f'Progress: {current_file/tot_files*100:.2f}%')
+    checkpoint_file.close()
 
-    df_hydroph = pd.DataFrame(data=hydrophob_data, columns=[
-                      'code','mut_count', 'hydrophilics_all', 'hydrophobics_all', 
-                      'hydrophilics_CDRs', 'hydrophobics_CDRs', 'len_CDRs', 'mut_count_CDRs', 
-                      'hydrophilics_FWk', 'hydrophobics_FWk', 'len_FWk', 'mut_count_framework', 
-                      'hydrophilics_L1', 'hydrophobics_L1', 'len_L1', 'mut_count_L1',
-                      'hydrophilics_L2', 'hydrophobics_L2', 'len_L2', 'mut_count_L2',
-                      'hydrophilics_L3', 'hydrophobics_L3', 'len_L3', 'mut_count_L3',
-                      'hydrophilics_H1', 'hydrophobics_H1', 'len_H1', 'mut_count_H1',
-                      'hydrophilics_H2', 'hydrophobics_H2', 'len_H2', 'mut_count_H2',
-                      'hydrophilics_H3', 'hydrophobics_H3', 'len_H3', 'mut_count_H3'])
-
-    df_hydroph.sort_values('mut_count', inplace=True)
-
-    df_final_hydroph = df_hydroph[2:].groupby('mut_count').aggregate('mean').reset_index()
-    # print(df_final_hydroph)
-    df_dist = df_hydroph[['code','mut_count', 'len_CDRs', 'hydrophilics_CDRs', 'hydrophobics_CDRs']]
-    df_dist['fraction_hydrophilic'] = df_dist['hydrophilics_CDRs'] / df_dist['len_CDRs']
-    df_dist['fraction_hydrophobic'] = df_dist['hydrophobics_CDRs'] / df_dist['len_CDRs']
-    
-    df_dist.to_csv('fractional_hydrophobicity_data.csv', index=False)
-    df_final_hydroph.to_csv('introduced_hydrophobicity_data.csv', index=False)
-    
-    graph.introduced_hydrophobicity(df_final_hydroph)
-    graph.introduced_fractional_hydrophobicity(df_dist)
+    with profiling_shm.stage('dataframes'):
+        if columnar:
+            residues = pd.read_csv(checkpoint, dtype=str, keep_default_na=False)
+            df_hydroph = residue_hydrophobicity_table(residues, scheme)
+        else:
+            df_hydroph = pd.read_csv(checkpoint, dtype={'code': str})
+
+        df_hydroph.sort_values('mut_count', inplace=True)
+
+        # The code column is not averaged
+        df_final_hydroph = df_hydroph[2:].drop(columns='code').groupby('mut_count').aggregate('mean').reset_index()
+        # print(df_final_hydroph)
+        df_dist = df_hydroph[['code','mut_count', 'len_CDRs', 'hydrophilics_CDRs', 'hydrophobics_CDRs']]
+        df_dist['fraction_hydrophilic'] = df_dist['hydrophilics_CDRs'] / df_dist['len_CDRs']
+        df_dist['fraction_hydrophobic'] = df_dist['hydrophobics_CDRs'] / df_dist['len_CDRs']
+
+        df_dist.to_csv('fractional_hydrophobicity_data.csv', index=False)
+        df_final_hydroph.to_csv('introduced_hydrophobicity_data.csv', index=False)
+
+    with profiling_shm.stage('graphing'):
+        specs = []
+        graph.introduced_hydrophobicity(df_final_hydroph, specs)
+        graph.introduced_fractional_hydrophobicity(df_dist, specs)
+        graph.render_specs(specs)
 
     return
 
@@ -353,18 +426,75 @@ def run_test_label_res_mut_skippedres2():
                      ['H112', 'S', 'Y'], ['H113', 'S', 'S']]
     utils_shm.check_equal(data, expected_data)
 
+
+def run_test_label_res_mut_leadingresnotaligned():
+    # The numbered G at H1 is not in the alignment; pairing it with the later G
+    # used to drop every residue before it
+    test_l_num = []
+    test_l_mut = []
+    test_h_num = [['H1', 'G'], ['H2', 'E'], ['H3', 'V'], ['H4', 'Q'], ['H5', 'L'], ['H6', 'G']]
+    test_h_mut = [['E', 'E'], ['V', 'V'], ['Q', 'K'], ['L', 'L'], ['G', 'G']]
+
+    data = label_res_mut(test_l_mut, test_h_mut, test_l_num, test_h_num)
+    expected_data = [['H2', 'E', 'E'], ['H3', 'V', 'V'], ['H4', 'Q', 'K'], ['H5', 'L', 'L'], ['H6', 'G', 'G']]
+    utils_shm.check_equal(data, expected_data)
+
 # *************************************************************************
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Compile.....')
     parser.add_argument(
-        '--fastadir', help='Directory of fasta files', required=True)
+        '--fastadir', help='Directory of fasta files, or a multi-FASTA file with a .fai index', required=True)
+    parser.add_argument(
+        '--timeout', help='Seconds before a hung abnum/agl run is killed (0 for no limit)', type=float, default=600)
+    parser.add_argument(
+        '--retries', help='Number of times a timed out run is retried before the input is quarantined',
+        type=int, default=1)
+    parser.add_argument(
+        '--cachedir', help='Directory for cached abnum/agl output', default='.shm_cache')
+    parser.add_argument(
+        '--cache_mb', help='Maximum size of the tool output cache in MB', type=float, default=2048)
+    parser.add_argument(
+        '--no_cache', help='Always rerun the external tools', action='store_true')
+    parser.add_argument(
+        '--agl_batch', help='Run agl once per batch of this many files (0 runs it once per file)', type=int, default=0)
+    parser.add_argument(
+        '--germlines', help='V and J germline FASTA files for assigning germlines in-process instead of running agl',
+        nargs='+')
+    parser.add_argument(
+        '--checkpoint', help='File that results are appended to as each antibody finishes',
+        default='hydrophobicity_checkpoint.csv')
+    parser.add_argument(
+        '--resume', help='Skip antibodies already in the checkpoint file', action='store_true')
+    parser.add_argument(
+        '--scheme', help='CDR definitions to use for the numbered positions', choices=list(regions_shm.SCHEMES),
+        default='default')
+    parser.add_argument(
+        '--columnar', help='Collect the residues of all antibodies into one table and count them together at the end',
+        action='store_true')
+    parser.add_argument(
+        '--profile', help='Write per-stage timings, tool latencies and peak memory to hydrophobicity_run_report.json',
+        action='store_true')
+    parser.add_argument(
+        '--cprofile', help='Also write cProfile data to this file (implies --profile)')
     args = parser.parse_args()
+    cache_shm.configure(args.cachedir, args.cache_mb, not args.no_cache)
+    tools_shm.configure(args.timeout, args.retries)
+    if args.profile or args.cprofile:
+        profiling_shm.enable(args.cprofile)
 
     run_test_parse_abnum_data_bothchains()
     run_test_parse_abnum_data_singlechainH()
     run_test_label_res_mut_noresiduesskippedwithin()
-    # run_test_label_res_mut_skippedres1()
-    # run_test_label_res_mut_skippedres2()
+    run_test_label_res_mut_skippedres1()
+    run_test_label_res_mut_skippedres2()
+    run_test_label_res_mut_leadingresnotaligned()
 
-    extract_mut_data(args.fastadir)
+    try:
+        extract_mut_data(args.fastadir, args.agl_batch, args.germlines, args.checkpoint, args.resume,
+                         args.columnar, args.scheme)
+        cache_shm.report()
+        tools_shm.write_quarantine()
+    finally:
+        # Written even if the run fails part way, showing where the time went
+        profiling_shm.write_report('hydrophobicity_run_report.json')
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# In-process VH/VL packing angle calculation.
+#
+# Follows the method used by abpackingangle (Abhinandan & Martin, PEDS 2010):
+# the Calpha atoms of a set of structurally conserved core positions in each
+# domain are fitted onto a reference domain for which a vector running along
+# the domain is known. The fitted rotation places the reference vector in the
+# structure, and the packing angle is the torsion angle between the VL and VH
+# vectors about the line joining the centroids of the two sets of core atoms.
+#
+# The reference core coordinates and vectors are read from a text file:
+#
+#   # comment
+#   CORE L35  x y z
+#   CORE H36  x y z
+#   ...
+#   VECTOR L  dx dy dz
+#   VECTOR H  dx dy dz
+#
+# so that results can be matched against abpackingangle using the same
+# reference data it was built with.
+#
+# The reference data abpackingangle uses, and angles it has recorded for known
+# structures, are not in this repository, so agreement with abpackingangle has
+# not been checked. Until it has, runAGL.py always runs abpackingangle and
+# this module is only a standalone calculation; the tests below check the
+# fitting and torsion steps on structures built with known angles.
+#
+# Usage: packingangle_shm.py --packref reference.dat file.cho [file.cho ...]
+
+import argparse
+import numpy as np
+import utils_shm
+
+
+def read_reference(path):
+    core = {'L': [], 'H': []}
+    vectors = {}
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if fields[0] == 'CORE':
+                pos = fields[1]
+                core[pos[0]].append((pos, [float(v) for v in fields[2:5]]))
+            elif fields[0] == 'VECTOR':
+                vectors[fields[1]] = np.array([float(v) for v in fields[2:5]])
+    ref = {}
+    for chain in ['L', 'H']:
+        if not core[chain] or chain not in vectors:
+            raise ValueError(f'{path}: no core positions or vector for chain {chain}')
+        ref[chain] = {'positions': [p for p, _ in core[chain]],
+                      'coords': np.array([c for _, c in core[chain]]),
+                      'vector': vectors[chain] / np.linalg.norm(vectors[chain])}
+    return ref
+
+
+def read_ca_coords(path):
+    # Returns {'L35': array([x, y, z]), 'H100A': ...} for the Calpha atoms of a
+    # Chothia numbered PDB file; only the first model is read
+    coords = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith('ENDMDL'):
+                break
+            if line.startswith('ATOM') and line[12:16].strip() == 'CA':
+                label = line[21] + line[22:26].strip() + line[26].strip()
+                if label not in coords:
+                    coords[label] = np.array([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+    return coords
+
+
+def fit_rotations(ref_coords, coords):
+    # Batched Kabsch fit: ref_coords (k, 3), coords (n, k, 3). Returns the
+    # rotations (n, 3, 3) that best map the centred reference onto each structure
+    # and the centroids (n, 3) of the structures
+    ref_centred = ref_coords - ref_coords.mean(axis=0)
+    centroids = coords.mean(axis=1)
+    centred = coords - centroids[:, None, :]
+    cov = np.einsum('ki,nkj->nij', ref_centred, centred)
+    u, _, vt = np.linalg.svd(cov)
+    d = np.sign(np.linalg.det(np.einsum('nji,nkj->nik', vt, u)))
+    fix = np.ones((len(coords), 3))
+    fix[:, 2] = d
+    rotations = np.einsum('nji,nj,nkj->nik', vt, fix, u)
+    return rotations, centroids
+
+
+def torsions(p1, p2, p3, p4):
+    # Torsion angles in degrees for arrays of points, each (n, 3)
+    b1 = p2 - p1
+    b2 = p3 - p2
+    b3 = p4 - p3
+    n1 = np.cross(b1, b2)
+    n2 = np.cross(b2, b3)
+    x = np.einsum('ij,ij->i', n1, n2)
+    y = np.linalg.norm(b2, axis=1) * np.einsum('ij,ij->i', b1, n2)
+    return np.degrees(np.arctan2(y, x))
+
+
+def packing_angles_from_coords(coord_sets, ref):
+    # Returns a list of packing angles for a list of {label: coords} dicts, with
+    # None for structures that are missing any of the core positions
+    angles = [None] * len(coord_sets)
+    complete = [i for i, c in enumerate(coord_sets)
+                if all(p in c for chain in ['L', 'H'] for p in ref[chain]['positions'])]
+    if not complete:
+        return angles
+
+    points = {}
+    for chain in ['L', 'H']:
+        positions = ref[chain]['positions']
+        coords = np.array([[coord_sets[i][p] for p in positions] for i in complete])
+        rotations, centroids = fit_rotations(ref[chain]['coords'], coords)
+        vectors = np.einsum('nij,j->ni', rotations, ref[chain]['vector'])
+        points[chain] = (centroids, centroids + vectors)
+
+    values = torsions(points['L'][1], points['L'][0], points['H'][0], points['H'][1])
+    for i, angle in zip(complete, values):
+        angles[i] = float(angle)
+    return angles
+
+
+def packing_angles(paths, ref):
+    coord_sets = []
+    for path in paths:
+        try:
+            coord_sets.append(read_ca_coords(path))
+        except (OSError, ValueError):
+            print(f'Could not read coordinates from {path}')
+            coord_sets.append({})
+    return packing_angles_from_coords(coord_sets, ref)
+
+
+def packing_angle(path, ref):
+    return packing_angles([path], ref)[0]
+
+
+def rotation_about(axis, degrees):
+    axis = np.asarray(axis, dtype=np.float64) / np.linalg.norm(axis)
+    x, y, z = axis
+    k = np.array([[0, -z, y], [z, 0, -x], [-y, x, 0]])
+    theta = np.radians(degrees)
+    return np.eye(3) + np.sin(theta) * k + (1 - np.cos(theta)) * k @ k
+
+
+def run_test_torsions():
+    p1 = np.array([[1.0, 0.0, 0.0]] * 3)
+    p2 = np.zeros((3, 3))
+    p3 = np.array([[0.0, 0.0, 1.0]] * 3)
+    p4 = np.array([[1.0, 0.0, 1.0], [0.0, 1.0, 1.0], [-1.0, 0.0, 1.0]])
+    utils_shm.check_equal([round(float(a), 6) for a in torsions(p1, p2, p3, p4)], [0.0, 90.0, 180.0])
+
+
+def run_test_fit_rotations():
+    ref_coords = np.array([[0.0, 0.0, 0.0], [3.8, 0.0, 0.0], [3.8, 3.8, 0.0], [0.0, 3.8, 1.5], [1.0, 2.0, 5.0]])
+    rotation = rotation_about([1, 2, 3], 40)
+    coords = np.array([ref_coords @ rotation.T + [10.0, -5.0, 2.0]])
+    rotations, centroids = fit_rotations(ref_coords, coords)
+    utils_shm.check_equal(bool(np.allclose(rotations[0], rotation)), True)
+    utils_shm.check_equal(bool(np.allclose(centroids[0], ref_coords.mean(axis=0) @ rotation.T + [10.0, -5.0, 2.0])),
+                          True)
+
+
+def run_test_packing_angles_from_coords():
+    # Each domain is the reference moved by a known rotation and translation,
+    # with the VH vector turned by 60 degrees about the line between the
+    # centroids, so the packing angle is 60. The second structure is missing
+    # a core position
+    core = np.array([[0.0, 0.0, 0.0], [3.8, 0.0, 0.0], [3.8, 3.8, 0.0], [0.0, 3.8, 1.5]])
+    ref = {'L': {'positions': ['L35', 'L36', 'L37', 'L38'], 'coords': core, 'vector': np.array([1.0, 0.0, 0.0])},
+           'H': {'positions': ['H36', 'H37', 'H38', 'H39'], 'coords': core, 'vector': np.array([1.0, 0.0, 0.0])}}
+    centred = core - core.mean(axis=0)
+    light = centred @ rotation_about([0, 1, 1], 25).T
+    heavy = centred @ (rotation_about([0, 0, 1], 60) @ rotation_about([0, 1, 1], 25)).T + [0.0, 0.0, 20.0]
+    structure = dict(zip(ref['L']['positions'], light))
+    structure.update(zip(ref['H']['positions'], heavy))
+    incomplete = dict(structure)
+    del incomplete['H39']
+    angles = packing_angles_from_coords([structure, incomplete], ref)
+    utils_shm.check_equal([round(angles[0], 6), angles[1]], [60.0, None])
+
+
+# *************************************************************************
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Calculate VH/VL packing angles without running abpackingangle')
+    parser.add_argument(
+        '--packref', help='Reference core coordinates and vectors', required=True)
+    parser.add_argument('files', nargs='+', help='Chothia numbered PDB files')
+    args = parser.parse_args()
+
+    run_test_torsions()
+    run_test_fit_rotations()
+    run_test_packing_angles_from_coords()
+
+    reference = read_reference(args.packref)
+    for file, angle in zip(args.files, packing_angles(args.files, reference)):
+        if angle is None:
+            print(f'{file} Packing angle not found')
+        else:
+            print(f'{file} {angle:f}')
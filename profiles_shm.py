@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# Position-specific somatic hypermutation profiles.
+#
+# From a table of numbered residues (code, position, input, germline) for many
+# antibodies, works out at every numbered position (L24, H33, H100A, ...) how
+# often the input residue differs from the germline, and which germline to
+# input substitutions are seen there. Antibodies are split into free and
+# complexed groups using a redundancy file as read by runAGL.
+#
+# The confidence intervals on the mutation frequencies come from a bootstrap
+# over antibodies. Each resample is a vector of multinomial weights (how many
+# times each antibody is drawn), so a batch of resamples is one matrix product
+# of the weights with the per-antibody counts.
+#
+# Usage: profiles_shm.py --residues residue_checkpoint.csv --redfile redundancy.txt
+
+import argparse
+import re
+import numpy as np
+import pandas as pd
+
+import runAGL
+import specificreschanges
+import substitutions_shm
+import utils_shm
+
+
+def load_residues(path):
+    # A residue table written by hydrophob_changes --columnar, or germline
+    # alignments as read by specificreschanges
+    if path.endswith('.csv'):
+        table = pd.read_csv(path, dtype=str, keep_default_na=False)
+    else:
+        table = specificreschanges.load_germalign_table(path)
+    return table.rename(columns={'L/H position': 'position'})
+
+
+def assign_groups(codes, redfile):
+    # Returns {code: 'free', 'complexed' or ''}. Codes are file names such as
+    # pdb1abc_0, and runAGL's redundancy names leave out the 'pdb'
+    free, complexed, all_redund = runAGL.parse_redund_file(redfile)
+    free_d, complexed_d, _ = runAGL.dict_for_names(free, complexed, all_redund)
+    groups = {}
+    for code in codes:
+        name = code[3:] if code.startswith('pdb') else code
+        groups[code] = 'free' if name in free_d else 'complexed' if name in complexed_d else ''
+    return groups
+
+
+def position_key(position):
+    match = re.match(r'([LH])(\d+)([A-Z]?)$', position)
+    if match is None:
+        return (2, 0, position)
+    return (0 if match.group(1) == 'L' else 1, int(match.group(2)), match.group(3))
+
+
+def position_counts(table):
+    # Returns (codes, positions, observed, mutated) where observed and mutated
+    # are (antibodies, positions) count arrays, the positions in numbering order
+    antibodies, codes = pd.factorize(table['code'])
+    position_idx, positions = pd.factorize(table['position'])
+    order = sorted(range(len(positions)), key=lambda i: position_key(positions[i]))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    flat = antibodies * len(positions) + rank[position_idx]
+    size = len(codes) * len(positions)
+    mutated = (table['input'] != table['germline']).to_numpy()
+    observed = np.bincount(flat, minlength=size).reshape(len(codes), len(positions))
+    mutated = np.bincount(flat, weights=mutated, minlength=size).reshape(len(codes), len(positions))
+    return np.asarray(codes), np.asarray(positions)[order], observed, mutated
+
+
+def bootstrap_frequencies(observed, mutated, n_boot=10000, ci=95, seed=None, batch=256):
+    # Percentile bootstrap interval of the mutation frequency at each position,
+    # resampling antibodies. Returns (low, high) arrays
+    rng = np.random.default_rng(seed)
+    n = len(observed)
+    if n == 0:
+        nan = np.full(observed.shape[1], np.nan)
+        return nan, nan
+    observed = observed.astype(np.float32)
+    mutated = mutated.astype(np.float32)
+    freqs = np.empty((n_boot, observed.shape[1]), dtype=np.float32)
+    for start in range(0, n_boot, batch):
+        size = min(batch, n_boot - start)
+        # Draw n antibodies with replacement for each resample and count the draws
+        draws = rng.integers(0, n, size=(size, n)) + np.arange(size)[:, None] * n
+        weights = np.bincount(draws.ravel(), minlength=size * n).reshape(size, n).astype(np.float32)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            freqs[start:start + size] = (weights @ mutated) / (weights @ observed)
+    tail = (100 - ci) / 2
+    with np.errstate(invalid='ignore'):
+        low, high = np.nanpercentile(freqs, [tail, 100 - tail], axis=0)
+    return low, high
+
+
+def substitution_spectra(table, positions):
+    # (positions, germline residue, input residue) counts, residues indexed as in utils_shm.RESIDUES
+    position_idx = pd.Index(positions).get_indexer(table['position'])
+    counts = substitutions_shm.substitution_matrices(position_idx, np.zeros(len(table), dtype=np.int64),
+                                                     utils_shm.encode_residues(table['germline'].fillna('-')),
+                                                     utils_shm.encode_residues(table['input'].fillna('-')),
+                                                     len(positions), 1)
+    return counts[:, 0]
+
+
+def group_profile(table, group, n_boot=10000, ci=95, seed=None):
+    # Returns (frequency table, spectrum table) for one group of antibodies
+    _, positions, observed, mutated = position_counts(table)
+    n_observed = observed.sum(axis=0)
+    n_mutated = mutated.sum(axis=0)
+    low, high = bootstrap_frequencies(observed, mutated, n_boot, ci, seed)
+    freq_df = pd.DataFrame({'group': group, 'position': positions,
+                            'n_antibodies': (observed > 0).sum(axis=0),
+                            'n_observed': n_observed, 'n_mutated': n_mutated.astype(int),
+                            'frequency': n_mutated / n_observed,
+                            f'ci{ci:g}_low': low, f'ci{ci:g}_high': high})
+
+    counts = substitution_spectra(table, positions)
+    residues = np.array(list(utils_shm.RESIDUES) + ['?'])
+    pos, germ, inp = np.nonzero(counts)
+    changed = germ != inp
+    spectrum_df = pd.DataFrame({'group': group, 'position': positions[pos[changed]],
+                                'germline': residues[germ[changed]], 'input': residues[inp[changed]],
+                                'count': counts[pos[changed], germ[changed], inp[changed]]})
+    return freq_df, spectrum_df
+
+
+def shm_profiles(table, groups, n_boot=10000, ci=95, seed=None):
+    # groups is {code: group name} as given by assign_groups()
+    freq_dfs = []
+    spectrum_dfs = []
+    table_groups = table['code'].map(groups)
+    for group in ['free', 'complexed', 'all']:
+        subset = table if group == 'all' else table[table_groups == group]
+        print(f'Profiling {subset["code"].nunique()} {group} antibodies...')
+        freq_df, spectrum_df = group_profile(subset, group, n_boot, ci, seed)
+        freq_dfs.append(freq_df)
+        spectrum_dfs.append(spectrum_df)
+    return pd.concat(freq_dfs, ignore_index=True), pd.concat(spectrum_dfs, ignore_index=True)
+
+
+def run_test_position_counts():
+    table = pd.DataFrame({'code': ['a', 'a', 'a', 'b', 'b', 'b'],
+                          'position': ['H101', 'H100A', 'L24', 'H100', 'H100A', 'L24'],
+                          'input': ['Y', 'D', 'S', 'G', 'E', 'S'],
+                          'germline': ['Y', 'G', 'R', 'G', 'E', 'S']})
+    codes, positions, observed, mutated = position_counts(table)
+    utils_shm.check_equal([codes.tolist(), positions.tolist()], [['a', 'b'], ['L24', 'H100', 'H100A', 'H101']])
+    utils_shm.check_equal(observed.tolist(), [[1, 0, 1, 1], [1, 1, 1, 0]])
+    utils_shm.check_equal(mutated.tolist(), [[1, 0, 1, 0], [0, 0, 0, 0]])
+
+
+def run_test_bootstrap_frequencies():
+    rng = np.random.default_rng(1)
+    observed = rng.integers(1, 4, size=(12, 5))
+    mutated = np.minimum(rng.integers(0, 3, size=(12, 5)), observed)
+    low, high = bootstrap_frequencies(observed, mutated, n_boot=500, seed=7, batch=64)
+    again = bootstrap_frequencies(observed, mutated, n_boot=500, seed=7, batch=64)
+    utils_shm.check_equal([low.tolist(), high.tolist()], [again[0].tolist(), again[1].tolist()])
+
+    # The same resamples drawn and summed one at a time
+    rng = np.random.default_rng(7)
+    freqs = []
+    for start in range(0, 500, 64):
+        for draw in rng.integers(0, 12, size=(min(64, 500 - start), 12)):
+            freqs.append(mutated[draw].sum(axis=0) / observed[draw].sum(axis=0))
+    expected_low, expected_high = np.percentile(freqs, [2.5, 97.5], axis=0)
+    utils_shm.check_equal([bool(np.allclose(low, expected_low, atol=1e-6)),
+                           bool(np.allclose(high, expected_high, atol=1e-6))], [True, True])
+
+    # Every antibody the same, so every resample gives the same frequency
+    low, high = bootstrap_frequencies(np.full((5, 2), 4), np.tile([1, 3], (5, 1)), n_boot=100, seed=0)
+    utils_shm.check_equal([low.tolist(), high.tolist()], [[0.25, 0.75], [0.25, 0.75]])
+
+
+# *************************************************************************
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Mutation frequency and substitution spectrum at each numbered position')
+    parser.add_argument(
+        '--residues', help='Residue table CSV (hydrophob_changes --columnar), Parquet/Feather file or directory '
+                           'of germline alignment CSV files', required=True)
+    parser.add_argument('--redfile', help='Redundancy file splitting free and complexed antibodies', required=True)
+    parser.add_argument('--boot', help='Number of bootstrap resamples', type=int, default=10000)
+    parser.add_argument('--ci', help='Confidence interval in percent', type=float, default=95)
+    parser.add_argument('--seed', help='Random seed for the bootstrap', type=int)
+    parser.add_argument('--out', help='Prefix of the output CSV files', default='shm_profile')
+    args = parser.parse_args()
+
+    run_test_position_counts()
+    run_test_bootstrap_frequencies()
+
+    residue_table = load_residues(args.residues)
+    antibody_groups = assign_groups(residue_table['code'].unique(), args.redfile)
+    frequencies, spectra = shm_profiles(residue_table, antibody_groups, args.boot, args.ci, args.seed)
+    frequencies.to_csv(f'{args.out}_frequencies.csv', index=False)
+    spectra.to_csv(f'{args.out}_spectra.csv', index=False)
+    print(f'Profiles written to {args.out}_frequencies.csv and {args.out}_spectra.csv')
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Opt-in timing and profiling for the SHM pipelines.
+#
+# with profiling_shm.stage('agl'):
+#     ...
+#
+# adds the wall and CPU time of the block to the 'agl' stage, together with the
+# peak memory allocated by Python while it ran (tracemalloc). tools_shm reports
+# the latency of every external tool run, which is kept as a histogram per
+# tool. write_report() writes everything to a JSON run report and, if asked for,
+# a cProfile dump. Nothing is recorded unless enable() has been called.
+
+import cProfile
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import cache_shm
+
+# Upper edges of the tool latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, float('inf')]
+
+enabled = False
+stages = {}
+tools = {}
+_stage_stack = []
+_profiler = None
+_cprofile_path = None
+_start = None
+
+
+def enable(cprofile_path=None):
+    global enabled, _profiler, _cprofile_path, _start
+    enabled = True
+    _start = time.perf_counter()
+    tracemalloc.start()
+    if cprofile_path is not None:
+        _cprofile_path = cprofile_path
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+@contextmanager
+def stage(name):
+    if not enabled:
+        yield
+        return
+    # Each open stage keeps the highest peak seen so far, since tracemalloc's
+    # peak is reset whenever a nested stage starts or ends
+    if _stage_stack:
+        _stage_stack[-1] = max(_stage_stack[-1], tracemalloc.get_traced_memory()[1])
+    _stage_stack.append(0)
+    tracemalloc.reset_peak()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        peak = max(_stage_stack.pop(), tracemalloc.get_traced_memory()[1])
+        if _stage_stack:
+            _stage_stack[-1] = max(_stage_stack[-1], peak)
+        tracemalloc.reset_peak()
+        record = stages.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_mem_mb': 0.0})
+        record['calls'] += 1
+        record['wall_s'] += wall
+        record['cpu_s'] += cpu
+        record['peak_mem_mb'] = max(record['peak_mem_mb'], peak / 1024 ** 2)
+
+
+def record_tool(tool, seconds):
+    if not enabled:
+        return
+    record = tools.setdefault(tool, {'calls': 0, 'total_s': 0.0, 'min_s': None, 'max_s': 0.0,
+                                     'histogram': [0] * len(LATENCY_BUCKETS)})
+    record['calls'] += 1
+    record['total_s'] += seconds
+    record['min_s'] = seconds if record['min_s'] is None else min(record['min_s'], seconds)
+    record['max_s'] = max(record['max_s'], seconds)
+    for i, edge in enumerate(LATENCY_BUCKETS):
+        if seconds <= edge:
+            record['histogram'][i] += 1
+            break
+
+
+def write_report(path):
+    if not enabled:
+        return
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_cprofile_path)
+        print(f'cProfile data written to {_cprofile_path}')
+    tool_report = {}
+    for tool, record in tools.items():
+        tool_report[tool] = dict(record, mean_s=record['total_s'] / record['calls'],
+                                 histogram={f'<={edge:g}s': n for edge, n in zip(LATENCY_BUCKETS, record['histogram'])})
+    report = {'total_wall_s': time.perf_counter() - _start,
+              'stages': stages,
+              'tools': tool_report,
+              'cache': dict(cache_shm.stats)}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Run report written to {path}')
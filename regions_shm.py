@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# CDR/framework regions of numbered antibody positions.
+#
+# Each scheme gives the first and last residue number of every CDR, in the
+# numbering the residues were labelled with (abnum -c for Chothia, -k for
+# Kabat, ...). For each scheme a lookup table from position label to region is
+# built once, and whole arrays of labels are then classified in one call:
+#
+#   regions_shm.classify(['L24', 'L27A', 'H52A', 'H110'], 'chothia')
+#   -> array(['L1', 'L1', 'H2', 'FW'])
+#
+# 'default' reproduces the positions these scripts have always used: plain
+# residue numbers and, of the insertions, only H100A-H100K, so other
+# insertions such as L27A or H52A are framework. 'default_insertions' has the
+# same boundaries but, like the other named schemes, gives every insertion
+# code the region of its base number. IMGT labels its insertions with decimals
+# (H111.1), which the 'imgt' scheme places with their base number and the
+# other schemes reject with a ValueError. Any other label that is not a valid
+# position is classed as framework.
+#
+# Usage: regions_shm.py --scheme kabat L27A H35B H100K
+
+import argparse
+import numpy as np
+import pandas as pd
+import utils_shm
+from functools import lru_cache
+
+CDRS = ['L1', 'L2', 'L3', 'H1', 'H2', 'H3']
+FRAMEWORK = 'FW'
+
+# CDR first and last residue numbers
+DEFAULT_CDRS = {'L1': (24, 34), 'L2': (50, 56), 'L3': (89, 97),
+                'H1': (31, 35), 'H2': (50, 58), 'H3': (95, 102)}
+SCHEMES = {'default': DEFAULT_CDRS,
+           'default_insertions': DEFAULT_CDRS,
+           'kabat': {'L1': (24, 34), 'L2': (50, 56), 'L3': (89, 97),
+                     'H1': (31, 35), 'H2': (50, 65), 'H3': (95, 102)},
+           'chothia': {'L1': (24, 34), 'L2': (50, 56), 'L3': (89, 97),
+                       'H1': (26, 32), 'H2': (52, 56), 'H3': (95, 102)},
+           'abm': {'L1': (24, 34), 'L2': (50, 56), 'L3': (89, 97),
+                   'H1': (26, 35), 'H2': (50, 58), 'H3': (95, 102)},
+           'imgt': {'L1': (27, 38), 'L2': (56, 65), 'L3': (105, 117),
+                    'H1': (27, 38), 'H2': (56, 65), 'H3': (105, 117)}}
+
+MAX_RESIDUE_NUMBER = 130
+INSERTION_CODES = [chr(c) for c in range(ord('A'), ord('Z') + 1)]
+# Schemes that only know some insertions, as {base position: insertion codes}
+LISTED_INSERTIONS = {'default': {'H100': 'ABCDEFGHIJK'}}
+DECIMAL_SCHEMES = ['imgt']
+DECIMAL_INSERTION = r'\.\d+$'
+
+
+@lru_cache(maxsize=None)
+def region_table(scheme):
+    # Returns (index of position labels, array of region names) for a scheme
+    if scheme not in SCHEMES:
+        raise ValueError(f'Unknown numbering scheme {scheme}, use one of {", ".join(SCHEMES)}')
+    labels = []
+    regions = []
+    for chain in ['L', 'H']:
+        for number in range(1, MAX_RESIDUE_NUMBER + 1):
+            region = FRAMEWORK
+            for cdr, (first, last) in SCHEMES[scheme].items():
+                if cdr[0] == chain and first <= number <= last:
+                    region = cdr
+            if scheme in LISTED_INSERTIONS:
+                codes = list(LISTED_INSERTIONS[scheme].get(f'{chain}{number}', ''))
+            else:
+                codes = INSERTION_CODES
+            for code in [''] + codes:
+                labels.append(f'{chain}{number}{code}')
+                regions.append(region)
+    return pd.Index(labels), np.array(regions + [FRAMEWORK], dtype=object)
+
+
+def classify(positions, scheme='default'):
+    # Returns an array with the region of each position label
+    labels, regions = region_table(scheme)
+    positions = pd.Index(positions, dtype=object)
+    decimal = positions.str.contains(DECIMAL_INSERTION, regex=True, na=False)
+    if decimal.any():
+        if scheme not in DECIMAL_SCHEMES:
+            raise ValueError(f'Position {positions[decimal][0]} has an IMGT insertion number, which the '
+                             f'{scheme} scheme does not use')
+        positions = positions.str.replace(DECIMAL_INSERTION, '', regex=True)
+    # Labels not in the table get -1, which picks the framework entry at the end
+    return regions[labels.get_indexer(positions)]
+
+
+def region(position, scheme='default'):
+    return classify([position], scheme)[0]
+
+
+def is_cdr(positions, scheme='default'):
+    return classify(positions, scheme) != FRAMEWORK
+
+
+def run_test_classify_default():
+    # The positions the scripts listed before the schemes were added
+    positions = ['L23', 'L24', 'L34', 'L35', 'L49', 'L50', 'L56', 'L57', 'L88', 'L89', 'L97', 'L98',
+                 'H30', 'H31', 'H35', 'H36', 'H49', 'H50', 'H58', 'H59', 'H94', 'H95', 'H102', 'H103',
+                 'H100A', 'H100K', 'H100L', 'L27A', 'H35A', 'H52A', 'H82A', 'H130', 'H131', 'X1']
+    expected = ['FW', 'L1', 'L1', 'FW', 'FW', 'L2', 'L2', 'FW', 'FW', 'L3', 'L3', 'FW',
+                'FW', 'H1', 'H1', 'FW', 'FW', 'H2', 'H2', 'FW', 'FW', 'H3', 'H3', 'FW',
+                'H3', 'H3', 'FW', 'FW', 'FW', 'FW', 'FW', 'FW', 'FW', 'FW']
+    utils_shm.check_equal(list(classify(positions)), expected)
+
+
+def run_test_classify_insertions():
+    positions = ['L27A', 'H35A', 'H35B', 'H36A', 'H52A', 'H82A', 'H100L', 'H100Z', 'L34Z', 'L23A']
+    utils_shm.check_equal(list(classify(positions, 'default_insertions')),
+                          ['L1', 'H1', 'H1', 'FW', 'H2', 'FW', 'H3', 'H3', 'L1', 'FW'])
+    utils_shm.check_equal(list(classify(['H31A', 'H32A', 'H35A', 'H52A', 'H57A'], 'chothia')),
+                          ['H1', 'H1', 'FW', 'H2', 'FW'])
+
+
+def run_test_classify_boundaries():
+    # The residue before, the first, the last and the residue after each CDR
+    for scheme, cdrs in SCHEMES.items():
+        positions = []
+        expected = []
+        for cdr, (first, last) in cdrs.items():
+            positions += [f'{cdr[0]}{first - 1}', f'{cdr[0]}{first}', f'{cdr[0]}{last}', f'{cdr[0]}{last + 1}']
+            expected += [FRAMEWORK, cdr, cdr, FRAMEWORK]
+        utils_shm.check_equal(list(classify(positions, scheme)), expected)
+
+
+def run_test_classify_imgt_decimal():
+    utils_shm.check_equal(list(classify(['H111.1', 'H112.13', 'H117.2', 'H118.1', 'L38.1'], 'imgt')),
+                          ['H3', 'H3', 'H3', 'FW', 'L1'])
+    try:
+        classify(['H100', 'H111.1'], 'kabat')
+        rejected = False
+    except ValueError:
+        rejected = True
+    utils_shm.check_equal(rejected, True)
+
+
+# *************************************************************************
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Print the CDR/framework region of numbered antibody positions')
+    parser.add_argument(
+        '--scheme', help='CDR definitions to use', choices=list(SCHEMES), default='default')
+    parser.add_argument('positions', nargs='+', help='Position labels, e.g. L27A or H100B')
+    args = parser.parse_args()
+
+    run_test_classify_default()
+    run_test_classify_insertions()
+    run_test_classify_boundaries()
+    run_test_classify_imgt_decimal()
+
+    for position, position_region in zip(args.positions, classify(args.positions, args.scheme)):
+        print(position, position_region)
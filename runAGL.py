@@ -12,11 +12,20 @@
 #            -a Show alignments and number of mismatches
 
 import argparse
+import hashlib
+import json
 import os
 import pandas as pd
-import subprocess
+import asyncio
 import re
 import graphing_shm as graph
+import cache_shm
+import tools_shm
+import germline_shm
+import profiling_shm
+
+
+RESULT_COLUMNS = ['VL', 'JL', 'VH', 'JH', 'angle']
 
 
 def filter_line(l, free, complexed):
@@ -82,57 +91,159 @@ def dict_for_names(free, complexed, all_red):
     return free_dic, complexed_dic, full_red_dic
 
 
-def extract_data(fastadir, pdbdir, files, dictionary):
-    error_files = []
-    col = ['code', 'VL', 'JL', 'VH', 'JH', 'angle']
-    dfdata = []
-    mismatch_data = []
-
-    def run_AGL(file, dire):
-        aglresult = ''
-        try:
-            path = os.path.join(dire, file)
-            result = (subprocess.check_output(
-                ['agl', '-a', path])).decode("utf-8")
-            aglresult = result
-        except subprocess.CalledProcessError:
-            print(f'AGL failed on {file}')
-            error_files.append(file)
-        return aglresult
-
-    def run_abpackingangle(pdb_code, pdb_file):
-        angle = 'Packing angle not found'
-        try:
-            angle = (subprocess.check_output(
-                ['abpackingangle', '-p', pdb_code, '-q', pdb_file])).decode("utf-8")
-            angle = angle.split()
-            angle = angle[1]
-        except subprocess.CalledProcessError:
-            print(f'abpackingangle failed on {file}')
-        return angle
+def parse_angle(result):
+    angle = 'Packing angle not found'
+    if result.split():
+        angle = result.split()[1]
+    return angle
 
-    for file in files:
-        print(file)
-        result = run_AGL(file, fastadir)
-        result = result.replace(' ', '')
-        temp = re.split('\n', result)
-        result_data = []
-        for line in temp:
-            if ':' in line:
-                result_data.append(line)
+
+def run_tools(files, fastadir, pdbdir, jobs=1, agl_batch=0, germlines=None, checkpoint=None, keys=None):
+    # Returns [VL, JL, VH, JH, angle] for each file, in the same order as files
+    # whatever the number of jobs. With a checkpoint file each result is
+    # appended to it, with the file's key from keys, as soon as it is ready
+    # and is not kept, so nothing is lost if the run is stopped and memory
+    # does not grow with the number of files
+    agl_results = [None] * len(files)
+    if germlines is not None:
+        # Germlines are assigned in this process instead of running agl
+        print(f'Assigning germlines for {len(files)} files...')
+        with profiling_shm.stage('germline_assignment'):
+            db = germline_shm.GermlineDB(germlines)
+            agl_results = [germline_shm.assign_file(os.path.join(fastadir, f), db) for f in files]
+    elif agl_batch > 0:
+        paths = [os.path.join(fastadir, f) for f in files]
+        print(f'Running agl on {len(paths)} files in batches of {agl_batch}...')
+        with profiling_shm.stage('agl_batches'):
+            batch_results = tools_shm.run_agl_batch(paths, ['agl', '-a'], agl_batch, jobs)
+        agl_results = [batch_results[p] for p in paths]
+
+    async def run_file(file, agl_result, semaphore):
+        # agl is skipped if its result is already known from a batched or in-process run
+        if agl_result is None:
+            path = os.path.join(fastadir, file)
+            agl_result = await tools_shm.run_tool_async(['agl', '-a', path], path, file, semaphore)
         code = file[3:-4]
-        redund_code = dictionary[code]
-        mismatch_data = [redund_code]
-        for data in result_data:
-            if data.startswith('Mismatches'):
-                data_list = data.split(':')
-                mismatch = int(data_list[1])
-                mismatch_data.append(mismatch)
         pdbfilepath = os.path.join(pdbdir, file[:-3]+'cho')
-        angle = run_abpackingangle(code.upper(), pdbfilepath)
-        mismatch_data.append(angle)
-        dfdata.append(mismatch_data)
-    df = pd.DataFrame(data=dfdata, columns=col)
+        angle = parse_angle(await tools_shm.run_tool_async(
+            ['abpackingangle', '-p', code.upper(), '-q', pdbfilepath], pdbfilepath, pdbfilepath, semaphore))
+        print(file)
+        data = parse_mismatches(agl_result) + [angle]
+        if checkpoint is not None:
+            checkpoint.write(json.dumps({'file': file, 'key': keys[file], 'data': data}) + '\n')
+            checkpoint.flush()
+            return None
+        return data
+
+    async def run_all(semaphore):
+        return await asyncio.gather(*(run_file(file, agl_result, semaphore)
+                                      for file, agl_result in zip(files, agl_results)))
+
+    with profiling_shm.stage('tool_runs'):
+        return tools_shm.run_async(run_all, jobs)
+
+
+def parse_mismatches(result):
+    result = result.replace(' ', '')
+    temp = re.split('\n', result)
+    result_data = []
+    for line in temp:
+        if ':' in line:
+            result_data.append(line)
+    mismatches = []
+    for data in result_data:
+        if data.startswith('Mismatches'):
+            data_list = data.split(':')
+            mismatch = int(data_list[1])
+            mismatches.append(mismatch)
+    return mismatches
+
+
+def checkpoint_entries(path, keys):
+    # Yields (file, data) for the lines of the checkpoint file whose key is
+    # the one in keys, so results made from other .faa/.cho contents or
+    # settings are ignored
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may have been cut short by a crash
+                continue
+            if entry['file'] in keys and entry.get('key') == keys[entry['file']]:
+                yield entry['file'], entry['data']
+
+
+def read_checkpoint(path, keys):
+    # The results in the checkpoint file as a frame indexed by file
+    files = []
+    rows = []
+    for file, data in checkpoint_entries(path, keys):
+        files.append(file)
+        rows.append(data)
+    df = pd.DataFrame(data=rows, index=files, columns=RESULT_COLUMNS)
+    return df[~df.index.duplicated(keep='last')]
+
+
+def open_checkpoint(path, resume):
+    if not resume:
+        return open(path, 'w')
+    # Start on a new line if the last one was cut short
+    needs_newline = False
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b'\n'
+    checkpoint = open(path, 'a')
+    if needs_newline:
+        checkpoint.write('\n')
+    return checkpoint
+
+
+def compute_file_data(fastadir, pdbdir, files, jobs=1, agl_batch=0, germlines=None, checkpoint=None,
+                      resume=False, signatures=None):
+    # Runs the tools once per file and returns a frame of RESULT_COLUMNS
+    # indexed by file. With a checkpoint file the results are only written
+    # there while the tools run, and the frame is read back from it at the
+    # end. With resume, files already in the checkpoint from the same .faa/.cho
+    # contents and settings are not run again. signatures gives the
+    # file_signature()s of the files' .faa and .cho files if already known
+    if checkpoint is None:
+        rows = run_tools(files, fastadir, pdbdir, jobs, agl_batch, germlines)
+        return pd.DataFrame(data=rows, index=files, columns=RESULT_COLUMNS)
+
+    settings = manifest_settings(germlines)
+    keys = {}
+    for file in files:
+        if signatures is not None:
+            sig = signatures[file]
+        else:
+            sig = {'faa': file_signature(os.path.join(fastadir, file)),
+                   'cho': file_signature(os.path.join(pdbdir, file[:-3]+'cho'))}
+        keys[file] = checkpoint_key(sig, settings)
+
+    done = set()
+    if resume:
+        done = set(file for file, _ in checkpoint_entries(checkpoint, keys))
+        print(f'Resuming: {len(done)} of {len(files)} files already in {checkpoint}')
+    todo = [f for f in files if f not in done]
+
+    checkpoint_file = open_checkpoint(checkpoint, resume)
+    try:
+        run_tools(todo, fastadir, pdbdir, jobs, agl_batch, germlines, checkpoint_file, keys)
+    finally:
+        checkpoint_file.close()
+    return read_checkpoint(checkpoint, keys)
+
+
+def build_df(file_data, files, dictionary):
+    col = ['code', 'VL', 'JL', 'VH', 'JH', 'angle']
+    # Built from the rows again so that the column types are the same however
+    # the results were put together
+    df = pd.DataFrame(data=file_data.loc[files].astype(object).values.tolist(), columns=RESULT_COLUMNS)
+    df.insert(0, 'code', [dictionary[file[3:-4]] for file in files])
     try:
         df = df[df['angle'].str.contains('Packing') == False]
     except:
@@ -154,6 +265,84 @@ def extract_data(fastadir, pdbdir, files, dictionary):
     return df
 
 
+def file_signature(path, old=None):
+    # [mtime, size, sha256] of a file, or None if it does not exist. The hash is
+    # only recalculated when the mtime or size differ from the old signature
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if old is not None and old[0] == st.st_mtime_ns and old[1] == st.st_size:
+        return old
+    return [st.st_mtime_ns, st.st_size, cache_shm.file_digest(path)]
+
+
+def checkpoint_key(signature, settings):
+    # Identifies the .faa/.cho contents and settings a result was made from
+    contents = [sig and sig[2] for sig in [signature['faa'], signature['cho']]]
+    return hashlib.sha256(json.dumps([contents, settings]).encode()).hexdigest()
+
+
+def same_contents(sig_a, sig_b):
+    if sig_a is None or sig_b is None:
+        return sig_a is None and sig_b is None
+    return sig_a[2] == sig_b[2]
+
+
+def manifest_settings(germlines):
+    # Results are only reused if they were made with the same tools and reference data
+    settings = {'agl': cache_shm.tool_version('agl'),
+                'abpackingangle': cache_shm.tool_version('abpackingangle'),
+                'germlines': None}
+    if germlines is not None:
+        settings['germlines'] = [cache_shm.file_digest(g) for g in germlines]
+    return settings
+
+
+def compute_file_data_incremental(fastadir, pdbdir, files, manifest_path, jobs=1, agl_batch=0,
+                                  germlines=None, checkpoint=None, resume=False):
+    # Reuses the results stored in the manifest for .faa/.cho files that have not
+    # changed, runs the tools on the rest and rewrites the manifest. Files that
+    # are no longer present are dropped from the manifest
+    settings = manifest_settings(germlines)
+    old_entries = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('settings') == settings:
+            old_entries = manifest['files']
+        else:
+            print('Tools or reference data have changed, reprocessing all files')
+
+    reused_files = []
+    reused_rows = []
+    entries = {}
+    todo = []
+    for file in files:
+        old = old_entries.get(file, {})
+        faa_sig = file_signature(os.path.join(fastadir, file), old.get('faa'))
+        cho_sig = file_signature(os.path.join(pdbdir, file[:-3]+'cho'), old.get('cho'))
+        entries[file] = {'faa': faa_sig, 'cho': cho_sig}
+        if 'data' in old and same_contents(old.get('faa'), faa_sig) and same_contents(old.get('cho'), cho_sig):
+            reused_files.append(file)
+            reused_rows.append(old['data'])
+        else:
+            todo.append(file)
+    print(f'{len(todo)} new or changed files, {len(files) - len(todo)} unchanged')
+
+    computed = compute_file_data(fastadir, pdbdir, todo, jobs, agl_batch, germlines, checkpoint, resume,
+                                 {file: entries[file] for file in todo})
+    file_data = pd.concat([pd.DataFrame(data=reused_rows, index=reused_files, columns=RESULT_COLUMNS), computed])
+    for file, *data in file_data.astype(object).itertuples():
+        entries[file]['data'] = data
+
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'settings': settings, 'files': entries}, f)
+    os.replace(tmp_path, manifest_path)
+    return file_data
+
+
 def find_maxrange_per_mutation_count(df, mut_col):
     max_df = df.groupby(mut_col).angle_range.agg(['max'])
     max_df.reset_index(inplace=True)
@@ -161,20 +350,33 @@ def find_maxrange_per_mutation_count(df, mut_col):
     return max_df
 
 
-def run_for_free_complexed(fastadir, pdbdir, free_d, complexed_d, both_d):
+def run_for_free_complexed(fastadir, pdbdir, free_d, complexed_d, both_d, jobs=1, agl_batch=0,
+                           germlines=None, manifest=None, checkpoint=None, resume=False):
     files = []
     for file in os.listdir(fastadir):
         if file.endswith('.faa'):
             files.append(file)
     files.sort()
 
+    # The groups overlap (complex_free covers most of the others), so the tools
+    # are run once on the union of files and the groups are built from the shared results
+    planned = [f for f in files if f[3:-4] in free_d or f[3:-4] in complexed_d or f[3:-4] in both_d]
+    print(f'Running agl and abpackingangle on {len(planned)} files...')
+    if manifest is not None:
+        file_data = compute_file_data_incremental(fastadir, pdbdir, planned, manifest, jobs, agl_batch,
+                                                  germlines, checkpoint, resume)
+    else:
+        file_data = compute_file_data(fastadir, pdbdir, planned, jobs, agl_batch, germlines, checkpoint,
+                                      resume)
+
     def find_mut(dictionary, group):
         files_list = [f for f in files if f[3:-4] in dictionary]
         print(f'Finding mutations for {group} antibodies...')
-        df = extract_data(fastadir, pdbdir, files_list, dictionary)
-        df = df.drop(df[df['angle_range'] == 0].index)
-        df = df.sort_values(by='angle_range', ascending=False)
-        df.to_csv(f'{group}_mutations.csv', index=False)
+        with profiling_shm.stage('dataframes'):
+            df = build_df(file_data, files_list, dictionary)
+            df = df.drop(df[df['angle_range'] == 0].index)
+            df = df.sort_values(by='angle_range', ascending=False)
+            df.to_csv(f'{group}_mutations.csv', index=False)
         return df
     
     free_df = find_mut(free_d, 'free')
@@ -183,8 +385,9 @@ def run_for_free_complexed(fastadir, pdbdir, free_d, complexed_d, both_d):
     return free_df, complex_df, free_complex_df
 
 
-def shm_graphing(free_df, complexed_df, f_c_df, proportion):
+def shm_graphing(free_df, complexed_df, f_c_df, proportion, aggregate=None, bins=100):
     pearson_data = []
+    specs = []
 
     def find_topx(df):
         top_x = len(df.index) * float(proportion)
@@ -200,11 +403,11 @@ def shm_graphing(free_df, complexed_df, f_c_df, proportion):
             max_df = find_maxrange_per_mutation_count(df, col)
             if col == 'total_mut':
                 p_all, p_max = graph.mutations_vs_angrange(
-                    df, col, 'VH + VL', './', graph_name, max_df)
+                    df, col, 'VH + VL', './', graph_name, max_df, specs, aggregate, bins)
                 pearson_list.append([f'VH + VL ({graph_name})', p_all, p_max])
             else:
                 p_all, p_max = graph.mutations_vs_angrange(
-                    df, col, col, './', graph_name, max_df)
+                    df, col, col, './', graph_name, max_df, specs, aggregate, bins)
                 pearson_list.append([f'{col} ({graph_name})', p_all, p_max])
         return pearson_list
 
@@ -216,6 +419,7 @@ def shm_graphing(free_df, complexed_df, f_c_df, proportion):
     pearson_data = pearson_data + graph_topx(free_df, 'free')
     pearson_data = pearson_data + graph_topx(complexed_df, 'complex')
     pearson_data  = pearson_data + graph_topx(f_c_df, 'complex_free')
+    graph.render_specs(specs)
     pearson_df = pd.DataFrame(data=pearson_data, columns=['Data', 'Correlation all', 'Correlation max'])
     pearson_df.to_csv('pearson_data.csv', index=False)
 
@@ -235,10 +439,60 @@ if __name__ == '__main__':
         '--pdbdir', help='Directory of pdb files', required=True)
     parser.add_argument(
         '--top_x', help='Fraction of samples, sorted by total number of mutations, which will be graphed', required=True)
+    parser.add_argument(
+        '--jobs', help='Number of agl/abpackingangle runs at once', type=int, default=1)
+    parser.add_argument(
+        '--agl_batch', help='Run agl once per batch of this many files (0 runs it once per file)', type=int, default=0)
+    parser.add_argument(
+        '--germlines', help='V and J germline FASTA files for assigning germlines in-process instead of running agl',
+        nargs='+')
+    parser.add_argument(
+        '--manifest', help='Manifest of processed files; only new or changed files are rerun')
+    parser.add_argument(
+        '--checkpoint', help='Append results to this file (e.g. runAGL_checkpoint.jsonl) as each file finishes')
+    parser.add_argument(
+        '--resume', help='Skip files already in the checkpoint file', action='store_true')
+    parser.add_argument(
+        '--timeout', help='Seconds before a hung agl/abpackingangle run is killed (0 for no limit)',
+        type=float, default=600)
+    parser.add_argument(
+        '--retries', help='Number of times a timed out run is retried before the input is quarantined',
+        type=int, default=1)
+    parser.add_argument(
+        '--cachedir', help='Directory for cached agl/abpackingangle output', default='.shm_cache')
+    parser.add_argument(
+        '--cache_mb', help='Maximum size of the tool output cache in MB', type=float, default=2048)
+    parser.add_argument(
+        '--no_cache', help='Always rerun the external tools', action='store_true')
+    parser.add_argument(
+        '--profile', help='Write per-stage timings, tool latencies and peak memory to runAGL_run_report.json',
+        action='store_true')
+    parser.add_argument(
+        '--cprofile', help='Also write cProfile data to this file (implies --profile)')
+    parser.add_argument(
+        '--aggregate', help='Plot binned point densities instead of every point, for very large datasets',
+        choices=graph.AGGREGATE_MODES)
+    parser.add_argument(
+        '--bins', help='Number of bins along each axis with --aggregate', type=int, default=100)
     args = parser.parse_args()
+    if args.resume and args.checkpoint is None:
+        parser.error('--resume needs --checkpoint')
+    cache_shm.configure(args.cachedir, args.cache_mb, not args.no_cache)
+    tools_shm.configure(args.timeout, args.retries)
+    if args.profile or args.cprofile:
+        profiling_shm.enable(args.cprofile)
 
-    free_list, complex_list, all_list = parse_redund_file(args.redfile)
-    dict_free, dict_complex, dict_all= dict_for_names(free_list, complex_list, all_list)
-    f_df, c_df, fc_df = run_for_free_complexed(args.fastadir, args.pdbdir,
-                           dict_free, dict_complex, dict_all)
-    shm_graphing(f_df, c_df, fc_df, args.top_x)
\ No newline at end of file
+    try:
+        with profiling_shm.stage('parse_redundancy'):
+            free_list, complex_list, all_list = parse_redund_file(args.redfile)
+            dict_free, dict_complex, dict_all= dict_for_names(free_list, complex_list, all_list)
+        f_df, c_df, fc_df = run_for_free_complexed(args.fastadir, args.pdbdir,
+                               dict_free, dict_complex, dict_all, args.jobs, args.agl_batch,
+                               args.germlines, args.manifest, args.checkpoint, args.resume)
+        cache_shm.report()
+        tools_shm.write_quarantine()
+        with profiling_shm.stage('graphing'):
+            shm_graphing(f_df, c_df, fc_df, args.top_x, args.aggregate, args.bins)
+    finally:
+        # Written even if the run fails part way, showing where the time went
+        profiling_shm.write_report('runAGL_run_report.json')
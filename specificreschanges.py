@@ -32,218 +32,112 @@
 
 
 import argparse
+import io
 import os
 import pandas as pd
-import subprocess
 import re
 import graphing_shm as graph
 import utils_shm
+import regions_shm
+import substitutions_shm
 import numpy as np
 from typing import List
 import seaborn as sns
-
-
-def run_abnum(file, dire):
-    abnumresult = ''
-    try:
-        path = os.path.join(dire, file)
-        result = (subprocess.check_output(
-            ['abnum', '-f', path])).decode("utf-8")
-        abnumresult = result
-    except subprocess.CalledProcessError:
-        print(f'abnum failed on {file}')
-    return abnumresult
-
-
-def run_AGL(file, dire):
-    aglresult = ''
+from concurrent.futures import ThreadPoolExecutor
+
+
+PARAM_COLUMNS = ['cdr_dY', 'cdr_dH', 'cdr_len', 'cdr_mut', 'fwk_dY', 'fwk_dH', 'fwk_len', 'fwk_mut',
+                 'fv_dY', 'fv_dH', 'fv_len', 'fv_mut']
+
+
+def params_from_matrices(counts, muts, scale='eisenberg'):
+    # Per-region net tyrosine change, hydrophobicity change, length and
+    # mutation count, from the substitution matrices and mutation counts of
+    # each antibody
+    dY = substitutions_shm.residue_change(counts, 'Y')
+    dH = substitutions_shm.property_change(counts, scale)
+    lengths = substitutions_shm.region_lengths(counts)
+    data = {}
+    for i, region in enumerate(substitutions_shm.REGIONS):
+        data[f'{region}_dY'] = dY[:, i]
+        data[f'{region}_dH'] = [float(f'{v:.2f}') for v in dH[:, i]]
+        data[f'{region}_len'] = lengths[:, i]
+        data[f'{region}_mut'] = muts[:, i]
+    return pd.DataFrame(data, columns=PARAM_COLUMNS)
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def load_germalign_dir(dire, jobs=8):
+    # Reads every per-antibody germline alignment CSV in a directory into one
+    # table, with the file name (less extension) as the antibody code. The
+    # files are read by a pool of threads and parsed together as one CSV, which
+    # is much faster than parsing thousands of small files one at a time
+    files = os.listdir(dire)
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        contents = list(pool.map(read_bytes, [os.path.join(dire, file) for file in files]))
+    if not contents:
+        return pd.DataFrame(columns=['code', 'L/H position', 'input', 'germline'])
+
+    header = contents[0].split(b'\n', 1)[0]
+    bodies = []
+    for content in contents:
+        first, _, body = content.partition(b'\n')
+        if first != header:
+            break
+        bodies.append(body if body.endswith(b'\n') or not body else body + b'\n')
+    n_rows = [body.count(b'\n') for body in bodies]
+    table = None
+    if len(bodies) == len(contents):
+        table = pd.read_csv(io.BytesIO(header + b'\n' + b''.join(bodies)))
+    if table is None or len(table) != sum(n_rows):
+        # Differing headers or blank lines; parse the files one by one
+        dfs = [pd.read_csv(io.BytesIO(content)) for content in contents]
+        n_rows = [len(df) for df in dfs]
+        table = pd.concat(dfs, ignore_index=True)
+    table.insert(0, 'code', np.repeat([os.path.splitext(file)[0] for file in files], n_rows))
+    return table
+
+
+def load_germalign_table(source, jobs=8):
+    # source is a directory of CSV files or a table written by compact_germalign_table()
+    if os.path.isdir(source):
+        return load_germalign_dir(source, jobs)
+    if source.endswith('.feather'):
+        return pd.read_feather(source)
+    return pd.read_parquet(source)
+
+
+def compact_germalign_table(table, path):
+    # Writes the whole table to one Parquet or Feather file (needs pyarrow)
+    # which later runs can read in place of the directory
     try:
-        path = os.path.join(dire, file)
-        result = (subprocess.check_output(
-            ['agl', '-a', path])).decode("utf-8")
-        aglresult = result
-    except subprocess.CalledProcessError:
-        print(f'AGL failed on {file}')
-    return aglresult
-
-
-def parse_abnum_data(num_res):
-    split_res_num = num_res.split('\n')
-
-    def make_LH_list(chain):
-        num_res_list = [i.strip() for i in split_res_num if i.strip().startswith(chain)]
-        num_res_list = [i.split(' ') for i in num_res_list]
-        return num_res_list
-    
-    num_res_l = []
-    num_res_h = []
-    if any('L' in line for line in split_res_num):
-        num_res_l = make_LH_list('L')
-    if any('H' in line for line in split_res_num):
-        num_res_h = make_LH_list('H')
-    return num_res_l, num_res_h
-
-
-def extract_abnum_data(in_file, dire):
-    numbered_residues = run_abnum(in_file, dire)
-    l_residues, h_residues = parse_abnum_data(numbered_residues)
-    return l_residues, h_residues
-
-
-def label_res_mut(l_muts, h_muts, l_num, h_num):
-    def pair_pos_num_w_res(mut_list, num_list):
-        res = []
-        n = 0
-        m = 0
-        # if len(num_list) == len(mut_list):
-        while n < len(num_list) and m < len(mut_list):
-            if num_list[n][1] == mut_list[m][0]:
-                # print([num_list[n][0], mut_list[m][0], mut_list[m][1]])
-                res.append([num_list[n][0], mut_list[m][0], mut_list[m][1]])
-                n += 1
-                m += 1
-
-        # else:
-        #     'Lists are not the same lenth...'
-            else:
-                for m_search in range(m + 1, len(mut_list)):
-                    if num_list[n][1] == mut_list[m_search][0]:
-                        res.append([num_list[n][0], mut_list[m_search][0], mut_list[m_search][1]])
-                        n += 1
-                        m = m_search + 1
-                        break
-                # else executed if break never happened
-                else:
-                    n += 1
-        return res
-    
-    l_list = pair_pos_num_w_res(l_muts, l_num)
-    h_list = pair_pos_num_w_res(h_muts, h_num)
-    return l_list + h_list
-
-def equalize_lists(str_a, str_b, padding = 'X'):
-    list_a = list(str_a)
-    list_b = list(str_b)
-    list_a += [padding] * (max(len(list_a), len(list_b)) - len(list_a))
-    list_b += [padding] * (max(len(list_a), len(list_b)) - len(list_b))
-    return list_a, list_b
-
-def char_range(c1, c2):
-    for c in range(ord(c1), ord(c2)+1):
-        yield chr(c)
-
-def dH_dy_changes(res_df):
+        if path.endswith('.feather'):
+            table.to_feather(path)
+        else:
+            table.to_parquet(path, index=False)
+    except ImportError as e:
+        print(f'Could not write {path}: {e}')
+        return
+    print(f'Germline alignments written to {path}')
 
-    def cal_y_changes(df):
-        # dYW_class = {'Y' : 'YW', 'W' : 'YW'}
-        # df['input_class'] = df['input'].map(dYW_class)
-        # df['germ_class'] = df['germline'].map(dYW_class)
-        # df_clear = df[df['input_class'] != df['germ_class']]
-        # germ_yw = 0
-        # input_yw = 0
-        # try:
-        #     germ_yw = int(df_clear['germ_class'].value_counts()['YW'])
-        # except:
-        #     germ_yw = 0
-        # try:
-        #     input_yw = int(df_clear['input_class'].value_counts()['YW'])
-        # except:
-        #     input_yw = 0
-        # return input_yw - germ_yw
-        df_clear = df[df['input'] != df['germline']]
-        germ_yw = 0
-        input_yw = 0
-        try:
-            germ_yw = int(df_clear['germline'].value_counts()['Y'])
-        except:
-            germ_yw = 0
-        try:
-            input_yw = int(df_clear['input'].value_counts()['Y'])
-        except:
-            input_yw = 0
-        return input_yw - germ_yw
 
-    def calc_hydrophobicity_change(df):
-        df['input_class'] = df['input'].map(utils_shm.hydrophobicity)
-        df['germ_class'] = df['germline'].map(utils_shm.hydrophobicity)
-        hydrophobiocity_change = df['input_class'].sum() - df['germ_class'].sum()
-        return float(f'{hydrophobiocity_change:.2f}')
+def align_germline_and_get_hydrophobic_changes(fastadir, scheme='default', scale='eisenberg', jobs=8,
+                                               compact=None, substitutions=None):
+    table = load_germalign_table(fastadir, jobs)
+    if compact is not None:
+        compact_germalign_table(table, compact)
 
-    def calc_params_for_regions(df):
-        cdrL1_pos = [f'L{i}' for i in range(24, 35)]
-        cdrL2_pos = [f'L{i}' for i in range(50, 57)]
-        cdrL3_pos = [f'L{i}' for i in range(89, 98)]
-        cdrH1_pos = [f'H{i}' for i in range(31, 36)]
-        cdrH2_pos = [f'H{i}' for i in range(50, 59)]
-        cdrH3_pos = [f'H{i}' for i in range(95, 103)] + [f'H100{i}' for i in char_range('A', 'K')]
-        cdr_pos = cdrL1_pos + cdrL2_pos + cdrL3_pos + cdrH1_pos + cdrH2_pos + cdrH3_pos
-        fwk_pos = [i for i in df['L/H position'].tolist() if i not in cdr_pos]
-        fv_pos = cdr_pos + fwk_pos
+    codes, counts, mutations = substitutions_shm.region_matrices(table, scheme)
+    if substitutions is not None:
+        substitutions_shm.save_matrices(substitutions, codes, counts, mutations)
+    return params_from_matrices(counts, mutations, scale)
 
-        def params_for_region(pos_list):
-            df_region = df[df['L/H position'].isin(pos_list)]
-            region_len = len(df_region.index)
-            df_region = df_region[df_region['input'] != df_region['germline']]
-            loop_mut_count = len(df_region.index)
-            return [cal_y_changes(df_region), calc_hydrophobicity_change(df_region), region_len, loop_mut_count]
-
-        return params_for_region(cdr_pos) + params_for_region(fwk_pos) + params_for_region(fv_pos)
-        
-    return calc_params_for_regions(res_df)
-
-
-def align_germline_and_get_hydrophobic_changes(fastadir):
-    files = os.listdir(fastadir)
-    abnum_fasta_dir = 'fasta_abnum'
-    abnum_df_dir = 'abnum_csv'
-    param_full_data = []
-
-    for file in files:
-        print(file)
-        posres_df = pd.read_csv(os.path.join(fastadir, file))
-        # resl, resh = extract_abnum_data(file, fastadir)
-        # num_file_data = resl+resh
-        # abnum_df = pd.DataFrame(data=num_file_data, columns=['res_pos', 'res'])
-        # abnum_df.to_csv(os.path.join(abnum_df_dir, f'abnum_{file[:4]}.csv'), index=False)
-        # abnum_file = f'abnum_{file}'
-
-        # input_L = ''
-        # germline_L = ''
-        # input_H = ''
-        # germline_H = ''
-        # result = run_AGL(abnum_file, abnum_fasta_dir)
-        # temp = result.replace('\n# ', 'splitter')
-        # temp = temp.replace('\n\n', 'splitter')
-        # temp = temp.split('splitter')
-        # temp = [t for t in temp if '>' not in t] 
-        # temp = [t.replace('Chain type: Heavy\n', '') for t in temp]
-        # temp = [t.replace('Chain type: Light\n', '') for t in temp]
-        # temp = [t for t in temp if t.startswith('VH') or t.startswith('VL')]
-        # temp = [t.replace(' ', '') for t in temp]
-        # temp = [t.split('\n') for t in temp]
-        # for t in temp:
-        #     if t[0].startswith('VL'):
-        #         input_L = input_L + t[1]
-        #         germline_L = germline_L + t[3]
-        #         input_L_list, germline_L_list = equalize_lists(input_L, germline_L)
-        #     if t[0].startswith('VH'):
-        #         input_H = input_H + t[1]
-        #         germline_H = germline_H + t[3]
-        #         input_H_list, germline_H_list = equalize_lists(input_H, germline_H)
-
-        # l_mut = [list(a) for a in zip(input_L_list, germline_L_list)]
-        # h_mut = [list(a) for a in zip(input_H_list, germline_H_list)]
-        
-        # res_pos_pairs = label_res_mut(l_mut, h_mut, resl, resh)
-        # posres_df = pd.DataFrame(data=res_pos_pairs, columns=['L/H position', 'input', 'germline'])
-        # posres_df.to_csv(os.path.join('mutgerm_files', f'{file[:-4]}_germalign.csv'), index=False)
-        param_full_data.append(dH_dy_changes(posres_df))
-
-    cols=['cdr_dY', 'cdr_dH', 'cdr_len', 'cdr_mut', 'fwk_dY', 'fwk_dH', 'fwk_len', 'fwk_mut', 'fv_dY', 'fv_dH', 'fv_len', 'fv_mut']
-    return pd.DataFrame(data=param_full_data, columns=cols)
-    
-def graphing_changes(param_df):
-    graph.hydrophobicity_change_vs_mutation(param_df)
+def graphing_changes(param_df, aggregate=None, bins=100):
+    graph.hydrophobicity_change_vs_mutation(param_df, aggregate=aggregate, bins=bins)
 
 
 
@@ -255,14 +149,26 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Compile.....')
     parser.add_argument(
-        '--fastadir', help='Directory of fasta files', required=True)
+        '--fastadir', help='Directory of germline alignment CSV files, or a Parquet/Feather file made with --compact',
+        required=True)
+    parser.add_argument(
+        '--scheme', help='CDR definitions to use for the numbered positions', choices=list(regions_shm.SCHEMES),
+        default='default')
+    parser.add_argument(
+        '--scale', help='Hydrophobicity scale for the dH values', choices=utils_shm.SCALE_NAMES, default='eisenberg')
+    parser.add_argument(
+        '--jobs', help='Number of threads reading the CSV files', type=int, default=8)
+    parser.add_argument(
+        '--compact', help='Also write all the alignments to this Parquet (.parquet) or Feather (.feather) file')
+    parser.add_argument(
+        '--substitutions', help='Also save the per-antibody, per-region substitution count matrices to this .npz file')
+    parser.add_argument(
+        '--aggregate', help='Plot binned point densities instead of every point, for very large datasets',
+        choices=graph.AGGREGATE_MODES)
+    parser.add_argument(
+        '--bins', help='Number of bins along each axis with --aggregate', type=int, default=100)
     args = parser.parse_args()
 
-    # run_test_parse_abnum_data_bothchains()
-    # run_test_parse_abnum_data_singlechainH()
-    # run_test_label_res_mut_noresiduesskippedwithin()
-    # run_test_label_res_mut_skippedres1()
-    # run_test_label_res_mut_skippedres2()
-
-    df_main = align_germline_and_get_hydrophobic_changes(args.fastadir)
-    graphing_changes(df_main)
+    df_main = align_germline_and_get_hydrophobic_changes(args.fastadir, args.scheme, args.scale, args.jobs,
+                                                         args.compact, args.substitutions)
+    graphing_changes(df_main, args.aggregate, args.bins)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Germline -> input substitution count matrices.
+#
+# counts[antibody, region, germline residue, input residue] is the number of
+# positions in the region of the antibody with that germline and input
+# residue, with the residues indexed as in utils_shm.RESIDUES (plus a last
+# index for unknown residues). The diagonal holds the unmutated positions. The
+# matrices for a whole dataset are built with one bincount, after which
+# residue counts and property changes are reductions over the last two axes:
+#
+#   dY = residue_change(counts, 'Y')
+#   dH = property_change(counts, 'eisenberg')
+#
+# property_change() weights every (germline, input) pair of a matrix by its
+# count and sums the changes with utils_shm.hydrophobicity_deltas(), so the
+# values are the same as those for the residues one by one.
+#
+# Every character outside utils_shm.RESIDUES (gaps, B, Z, ...) shares the
+# unknown index, so a '-' -> 'B' change sits on the diagonal. Mutation counts
+# are therefore taken from the residue strings, not from the matrices.
+
+import numpy as np
+import pandas as pd
+
+import regions_shm
+import utils_shm
+
+N_CODES = len(utils_shm.RESIDUES) + 1
+REGIONS = ['cdr', 'fwk', 'fv']
+
+
+def substitution_matrices(antibodies, regions, germline_codes, input_codes, n_antibodies, n_regions):
+    # antibodies and regions are integer indexes for each residue
+    flat = ((antibodies * n_regions + regions) * N_CODES + germline_codes) * N_CODES + input_codes
+    counts = np.bincount(flat, minlength=n_antibodies * n_regions * N_CODES * N_CODES)
+    return counts.reshape(n_antibodies, n_regions, N_CODES, N_CODES)
+
+
+def region_matrices(table, scheme='default'):
+    # table has 'code', 'L/H position', 'input' and 'germline' columns. Returns
+    # (codes, counts, mutations) with counts and mutation counts for the
+    # REGIONS of each code, the codes in the order they first appear
+    antibodies, codes = pd.factorize(table['code'])
+    is_fwk = (regions_shm.classify(table['L/H position'], scheme) == regions_shm.FRAMEWORK).astype(int)
+    counts = substitution_matrices(antibodies, is_fwk,
+                                   utils_shm.encode_residues(table['germline'].fillna('-')),
+                                   utils_shm.encode_residues(table['input'].fillna('-')),
+                                   len(codes), 2)
+    mutated = (table['input'] != table['germline']).to_numpy()
+    mutations = np.bincount(antibodies * 2 + is_fwk, weights=mutated,
+                            minlength=len(codes) * 2).reshape(len(codes), 2).astype(np.int64)
+    codes = np.asarray(codes)
+    return (codes, np.concatenate([counts, counts.sum(axis=1, keepdims=True)], axis=1),
+            np.concatenate([mutations, mutations.sum(axis=1, keepdims=True)], axis=1))
+
+
+def region_lengths(counts):
+    return counts.sum(axis=(-2, -1))
+
+
+def residue_change(counts, residues):
+    # Number of the residues gained minus the number lost; unmutated positions cancel
+    idx = [utils_shm.RESIDUES.index(r) for r in residues]
+    return counts[..., idx].sum(axis=(-2, -1)) - counts[..., idx, :].sum(axis=(-2, -1))
+
+
+def property_change(counts, scale='eisenberg'):
+    # Summed input minus germline hydrophobicity on one of utils_shm.SCALE_NAMES
+    n_groups = int(np.prod(counts.shape[:-2]))
+    germline_codes, input_codes = np.divmod(np.arange(N_CODES * N_CODES), N_CODES)
+    groups = np.repeat(np.arange(n_groups), N_CODES * N_CODES)
+    deltas = utils_shm.hydrophobicity_deltas(np.tile(input_codes, n_groups), np.tile(germline_codes, n_groups),
+                                             groups, n_groups, [scale], counts.reshape(-1))
+    return deltas[0].reshape(counts.shape[:-2])
+
+
+def save_matrices(path, codes, counts, mutations):
+    np.savez_compressed(path, codes=np.asarray(codes, dtype=str), regions=REGIONS, residues=list(utils_shm.RESIDUES) + ['?'],
+                        counts=counts, mutations=mutations)
+
+
+def run_test_residue_and_property_change():
+    # Antibody 0: S->Y and Y->Y in the CDRs, Y->F in the framework.
+    # Antibody 1: G->D in the CDRs
+    code = utils_shm.RESIDUES.index
+    counts = np.zeros((2, 3, N_CODES, N_CODES), dtype=np.int64)
+    counts[0, 0, code('S'), code('Y')] = 1
+    counts[0, 0, code('Y'), code('Y')] = 1
+    counts[0, 1, code('Y'), code('F')] = 1
+    counts[1, 0, code('G'), code('D')] = 1
+    counts[:, 2] = counts[:, 0] + counts[:, 1]
+    utils_shm.check_equal(residue_change(counts, 'Y').tolist(), [[1, -1, 0], [0, 0, 0]])
+    utils_shm.check_equal(residue_change(counts, 'DF').tolist(), [[0, 1, 1], [1, 0, 1]])
+    # Eisenberg: Y - S = 0.02 + 0.26, F - Y = 0.61 - 0.02, D - G = -0.72 - 0.16
+    utils_shm.check_equal(np.round(property_change(counts, 'eisenberg'), 2).tolist(),
+                          [[0.28, 0.59, 0.87], [-0.88, 0.0, -0.88]])
+    # Kyte & Doolittle: Y - S = -1.3 + 0.8, F - Y = 2.8 + 1.3, D - G = -3.5 + 0.4
+    utils_shm.check_equal(np.round(property_change(counts, 'kyte_doolittle'), 2).tolist(),
+                          [[-0.5, 4.1, 3.6], [-3.1, 0.0, -3.1]])
+    utils_shm.check_equal(region_lengths(counts).tolist(), [[2, 1, 3], [1, 0, 1]])
+
+
+def run_test_region_matrices():
+    # The same residues as a table. The '-' -> 'B' change of antibody 1 sits
+    # on the unknown diagonal of the matrices but still counts as a mutation
+    table = pd.DataFrame({'code': ['a', 'a', 'a', 'b', 'b'],
+                          'L/H position': ['L24', 'L25', 'H10', 'H31', 'H1'],
+                          'germline': ['S', 'Y', 'Y', 'G', '-'],
+                          'input': ['Y', 'Y', 'F', 'D', 'B']})
+    codes, counts, mutations = region_matrices(table)
+    code = utils_shm.RESIDUES.index
+    unknown = utils_shm.UNKNOWN_RESIDUE
+    utils_shm.check_equal(codes.tolist(), ['a', 'b'])
+    utils_shm.check_equal([int(counts[0, 0, code('S'), code('Y')]), int(counts[0, 1, code('Y'), code('F')]),
+                           int(counts[1, 0, code('G'), code('D')]), int(counts[1, 1, unknown, unknown])],
+                          [1, 1, 1, 1])
+    utils_shm.check_equal(int(counts.sum()), 2 * len(table))
+    utils_shm.check_equal(mutations.tolist(), [[1, 1, 2], [1, 1, 2]])
+
+
+# *************************************************************************
+if __name__ == '__main__':
+    run_test_residue_and_property_change()
+    run_test_region_matrices()
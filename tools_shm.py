@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+# Running the external tools (agl, abnum, abpackingangle).
+#
+# Every tool call goes through run_tool_async(), which checks the tool cache,
+# starts the tool with asyncio.create_subprocess_exec and kills it if it runs
+# longer than the timeout. Timed out calls are retried a limited number of
+# times; after that the input is put in quarantine and skipped for the rest of
+# the run, so that one stuck input cannot stall a whole run. A semaphore limits
+# the number of tools running at once.
+#
+# agl loads its germline database every time it starts, so starting it once per
+# .faa file is expensive. run_agl_batch() joins many files into one
+# multi-record FASTA, sends it to agl on stdin once per batch and splits the
+# output back into per-file results using the '>Chain' headers agl echoes for
+# every record.
+#
+# As in cache_shm, the settings are kept in environment variables so that
+# worker processes see the same values.
+
+import asyncio
+import os
+import signal
+import subprocess
+import time
+
+import cache_shm
+import profiling_shm
+
+quarantine = []
+
+
+def configure(timeout=None, retries=None):
+    if timeout is not None:
+        os.environ['SHM_TOOL_TIMEOUT'] = str(timeout)
+    if retries is not None:
+        os.environ['SHM_TOOL_RETRIES'] = str(retries)
+
+
+def tool_timeout():
+    # Seconds, or None for no timeout
+    timeout = float(os.environ.get('SHM_TOOL_TIMEOUT', 600))
+    return timeout if timeout > 0 else None
+
+
+def tool_retries():
+    return int(os.environ.get('SHM_TOOL_RETRIES', 1))
+
+
+async def check_output_async(args, input_path=None, semaphore=None, timeout=None, input_data=None, name=None,
+                             can_quarantine=True):
+    # Like subprocess.check_output(args). input_data (bytes) is sent to the
+    # tool on stdin. The output is cached when input_path or input_data is
+    # given. Raises CalledProcessError if the tool fails and TimeoutExpired
+    # once the retries have timed out; the input is then put in quarantine
+    # unless can_quarantine is False
+    label = input_path or name or ' '.join(args)
+    if can_quarantine and label in quarantine:
+        raise subprocess.TimeoutExpired(args, timeout)
+
+    key = None
+    if cache_shm.is_enabled():
+        if input_data is not None:
+            key = cache_shm.data_key(args, input_data)
+        elif input_path is not None and os.path.isfile(input_path):
+            key = cache_shm.make_key(args, input_path)
+    if key is not None:
+        data = cache_shm.lookup(key)
+        if data is not None:
+            return data
+
+    if timeout is None:
+        timeout = tool_timeout()
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(1)
+    for attempt in range(tool_retries() + 1):
+        async with semaphore:
+            started = time.perf_counter()
+            # A new session lets the whole process group be killed, including
+            # any children still holding the output pipe open
+            stdin = asyncio.subprocess.PIPE if input_data is not None else None
+            proc = await asyncio.create_subprocess_exec(*args, stdin=stdin, stdout=asyncio.subprocess.PIPE,
+                                                        start_new_session=True)
+            try:
+                stdout, _ = await asyncio.wait_for(proc.communicate(input_data), timeout)
+            except asyncio.TimeoutError:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                await proc.wait()
+                profiling_shm.record_tool(args[0], time.perf_counter() - started)
+                print(f'{args[0]} timed out after {timeout}s on {label} (attempt {attempt + 1})')
+                continue
+            profiling_shm.record_tool(args[0], time.perf_counter() - started)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, args, stdout)
+        if key is not None:
+            cache_shm.store(key, stdout)
+        return stdout
+
+    if can_quarantine:
+        quarantine.append(label)
+    raise subprocess.TimeoutExpired(args, timeout)
+
+
+async def run_tool_async(args, input_path, name, semaphore=None, input_data=None):
+    # Returns the decoded tool output, or '' if the tool failed
+    result = ''
+    try:
+        result = (await check_output_async(args, input_path, semaphore, None, input_data, name)).decode("utf-8")
+    except subprocess.CalledProcessError:
+        print(f'{args[0]} failed on {name}')
+    except subprocess.TimeoutExpired:
+        print(f'{args[0]} gave up on quarantined input {name}')
+    return result
+
+
+def run_tool(args, input_path, name, input_data=None):
+    return asyncio.run(run_tool_async(args, input_path, name, None, input_data))
+
+
+def run_async(func, jobs=1):
+    # Runs the coroutine function func(semaphore) in a new event loop; the
+    # semaphore limits the number of tools running at once
+    async def main():
+        return await func(asyncio.Semaphore(max(1, jobs)))
+    return asyncio.run(main())
+
+
+def write_quarantine(path='quarantine.txt'):
+    if quarantine:
+        print(f'{len(quarantine)} inputs were quarantined after timing out, see {path}')
+        with open(path, 'w') as f:
+            f.write('\n'.join(quarantine) + '\n')
+
+
+def parse_fasta_records(lines):
+    # Returns a list of [header, sequence lines] for each record
+    records = []
+    for line in lines:
+        line = line.rstrip('\n')
+        if line.startswith('>'):
+            records.append([line, []])
+        elif line.strip() and records:
+            records[-1][1].append(line.strip())
+    return records
+
+
+def read_fasta_records(path):
+    with open(path, 'r') as f:
+        return parse_fasta_records(f)
+
+
+def split_agl_output(output):
+    # Splits agl output into one block of text per input record
+    blocks = []
+    for line in output.splitlines(keepends=True):
+        if line.startswith('>'):
+            blocks.append(line)
+        elif blocks:
+            blocks[-1] += line
+    return blocks
+
+
+async def run_agl_on_batch(items, agl_args, semaphore):
+    # items is a list of (name, FASTA text, cache key); the batch is sent to
+    # agl on stdin
+    batch_records = []
+    n_records = []
+    for _, text, _ in items:
+        records = parse_fasta_records(text.splitlines())
+        batch_records.extend(records)
+        n_records.append(len(records))
+    batch_text = ''.join(header + '\n' + '\n'.join(seq) + '\n' for header, seq in batch_records)
+
+    # A batch is never quarantined; if it times out its inputs are run one at
+    # a time below, and only an input that times out on its own is quarantined
+    timeout = tool_timeout()
+    label = 'batch of ' + ', '.join(name for name, _, _ in items)
+    try:
+        output = (await check_output_async(agl_args, None, semaphore, timeout * len(items) if timeout else None,
+                                           batch_text.encode('utf-8'), label, False)).decode("utf-8")
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        output = None
+
+    blocks = split_agl_output(output) if output is not None else []
+    headers = [header for header, _ in batch_records]
+    if len(blocks) != len(batch_records) or \
+            any(not b.startswith(h) for b, h in zip(blocks, headers)):
+        # One bad record fails the whole batch, so fall back to running one at a time
+        print(f'Batched agl run failed, running {len(items)} inputs one at a time')
+        outputs = await asyncio.gather(*(run_tool_async(agl_args, None, name, semaphore, text.encode('utf-8'))
+                                         for name, text, _ in items))
+    else:
+        outputs = []
+        start = 0
+        for n in n_records:
+            outputs.append(''.join(blocks[start:start + n]))
+            start += n
+
+    results = {}
+    for (name, _, key), result in zip(items, outputs):
+        if key is not None and result:
+            cache_shm.store(key, result.encode('utf-8'))
+        results[name] = result
+    return results
+
+
+def run_agl_items(items, agl_args, batch_size, jobs=1):
+    results = {}
+    todo = []
+    for item in items:
+        name, _, key = item
+        cached = cache_shm.lookup(key) if key is not None else None
+        if cached is not None:
+            results[name] = cached.decode("utf-8")
+        else:
+            todo.append(item)
+
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+
+    async def run_batches(semaphore):
+        return await asyncio.gather(*(run_agl_on_batch(batch, agl_args, semaphore) for batch in batches))
+
+    for batch_results in run_async(run_batches, jobs):
+        results.update(batch_results)
+    return results
+
+
+def run_agl_batch(paths, agl_args, batch_size, jobs=1):
+    # Returns {path: agl output}, the same as running agl_args + [path] on each
+    # path. Files already in the tool cache are not sent to agl again
+    items = []
+    for path in paths:
+        with open(path, 'r') as f:
+            text = f.read()
+        key = cache_shm.make_key(agl_args + [path], path) if cache_shm.is_enabled() else None
+        items.append((path, text, key))
+    return run_agl_items(items, agl_args, batch_size, jobs)
+
+
+def run_agl_batch_texts(texts, agl_args, batch_size, jobs=1):
+    # The same as run_agl_batch() for {name: FASTA text}, with the results
+    # cached as if each text had been sent to agl_args on stdin
+    items = [(name, text, cache_shm.data_key(agl_args, text.encode('utf-8')) if cache_shm.is_enabled() else None)
+             for name, text in texts.items()]
+    return run_agl_items(items, agl_args, batch_size, jobs)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
+import numpy as np
 
 def check_equal(computed, expected):
     test_name = sys._getframe().f_back.f_code.co_name
@@ -30,15 +31,80 @@ def one_letter_code(pdb, res):
     return one_letter
 
 
-def hydrophobicity(resi):
+# Hydrophobicity scales. Residues not in a scale count as 0, and X as the
+# value given (Eisenberg) or the mean of the scale
+HYDROPHOBICITY_SCALES = {
     # 3. eisenberg consensus hydrophobicity
     # Consensus values: Eisenberg, et al 'Faraday Symp.Chem.Soc'17(1982)109
-    Hydrophathy_index = {'A': 0.25, 'R': -1.76, "N": -0.64, "D": -0.72, "C": 0.04, "Q": -0.69, "E": -0.62,
-                         "G": 0.16, "H": -0.40, "I": 0.73, "L": 0.53, "K": -1.10, "M": 0.26, "F": 0.61,
-                         "P": -0.07,
-                         "S": -0.26, "T": -0.18, "W": 0.37, "Y": 0.02, "V": 0.54, "X": -0.5}  # -0.5 is average
-    if resi in list(Hydrophathy_index.keys()):
-        hydrophobicity = Hydrophathy_index[resi]
-    else:
-        hydrophobicity = 0
-    return hydrophobicity
\ No newline at end of file
+    'eisenberg': {'A': 0.25, 'R': -1.76, "N": -0.64, "D": -0.72, "C": 0.04, "Q": -0.69, "E": -0.62,
+                  "G": 0.16, "H": -0.40, "I": 0.73, "L": 0.53, "K": -1.10, "M": 0.26, "F": 0.61,
+                  "P": -0.07,
+                  "S": -0.26, "T": -0.18, "W": 0.37, "Y": 0.02, "V": 0.54, "X": -0.5},  # -0.5 is average
+    # Kyte & Doolittle, J.Mol.Biol. 157(1982)105
+    'kyte_doolittle': {'A': 1.8, 'R': -4.5, 'N': -3.5, 'D': -3.5, 'C': 2.5, 'Q': -3.5, 'E': -3.5,
+                       'G': -0.4, 'H': -3.2, 'I': 4.5, 'L': 3.8, 'K': -3.9, 'M': 1.9, 'F': 2.8,
+                       'P': -1.6, 'S': -0.8, 'T': -0.7, 'W': -0.9, 'Y': -1.3, 'V': 4.2},
+    # Hopp & Woods, PNAS 78(1981)3824 (a hydrophilicity scale)
+    'hopp_woods': {'A': -0.5, 'R': 3.0, 'N': 0.2, 'D': 3.0, 'C': -1.0, 'Q': 0.2, 'E': 3.0,
+                   'G': 0.0, 'H': -0.5, 'I': -1.8, 'L': -1.8, 'K': 3.0, 'M': -1.3, 'F': -2.5,
+                   'P': 0.0, 'S': 0.3, 'T': -0.4, 'W': -3.4, 'Y': -2.3, 'V': -1.5},
+    # Engelman, Steitz & Goldman (GES), Annu.Rev.Biophys.Biophys.Chem. 15(1986)321
+    'engelman': {'A': 1.6, 'R': -12.3, 'N': -4.8, 'D': -9.2, 'C': 2.0, 'Q': -4.1, 'E': -8.2,
+                 'G': 1.0, 'H': -3.0, 'I': 3.1, 'L': 2.8, 'K': -8.8, 'M': 3.4, 'F': 3.7,
+                 'P': -0.2, 'S': 0.6, 'T': 1.2, 'W': 1.9, 'Y': -0.7, 'V': 2.6},
+}
+
+RESIDUES = 'ACDEFGHIKLMNPQRSTVWYX'
+UNKNOWN_RESIDUE = len(RESIDUES)
+RESIDUE_CODES = np.full(256, UNKNOWN_RESIDUE, dtype=np.uint8)
+RESIDUE_CODES[np.frombuffer(RESIDUES.encode('ascii'), dtype=np.uint8)] = np.arange(len(RESIDUES))
+
+
+def scale_row(scale):
+    # The values of a scale in residue code order, with X the mean of the
+    # scale if it has no value of its own, and 0 for unknown residues
+    mean = round(float(np.mean([scale[r] for r in RESIDUES if r != 'X'])), 2)
+    return [scale.get(r, mean) for r in RESIDUES] + [0]
+
+
+SCALE_NAMES = list(HYDROPHOBICITY_SCALES)
+# One row per scale, one column per residue code, the last column for residues
+# that are not known
+SCALE_TABLE = np.array([scale_row(HYDROPHOBICITY_SCALES[name]) for name in SCALE_NAMES])
+
+
+def encode_residues(residues):
+    """
+    One-letter residues to uint8 residue codes.
+
+    Input:  residues     --- A string, or a sequence of one-letter strings
+    Return: codes        --- uint8 array of indexes into RESIDUES
+    """
+    text = residues if isinstance(residues, str) else ''.join(residues)
+    if len(text) != len(residues):
+        raise ValueError('Residues must be one-letter codes')
+    return RESIDUE_CODES[np.frombuffer(text.encode('ascii'), dtype=np.uint8)]
+
+
+def hydrophobicity_values(codes, scales=None):
+    # Values of the residue codes on each scale, shape (scales, residues)
+    rows = [SCALE_NAMES.index(s) for s in scales] if scales is not None else slice(None)
+    return SCALE_TABLE[rows][:, codes]
+
+
+def hydrophobicity_deltas(input_codes, germline_codes, groups, n_groups, scales=None, weights=None):
+    """
+    Summed input minus germline hydrophobicity for groups of residues.
+
+    Input:  input_codes     --- Residue codes of the input residues
+            germline_codes  --- Residue codes of the germline residues
+            groups          --- Group index (e.g. antibody * regions + region) of each residue
+            n_groups        --- Number of groups
+            scales          --- Scale names (default all of SCALE_NAMES)
+            weights         --- Number of times each residue pair counts (default once)
+    Return: deltas          --- Array (scales, n_groups)
+    """
+    diff = hydrophobicity_values(input_codes, scales) - hydrophobicity_values(germline_codes, scales)
+    if weights is not None:
+        diff = diff * weights
+    return np.stack([np.bincount(groups, weights=d, minlength=n_groups) for d in diff])